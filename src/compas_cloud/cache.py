@@ -0,0 +1,480 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import json
+import os
+import re
+import sys
+from collections import OrderedDict
+from threading import Lock
+from threading import RLock
+
+from compas.utilities import DataEncoder
+from compas.utilities import DataDecoder
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+__all__ = ['Cache', 'Memo', 'Namespaces', 'sizeof', 'readonly', 'SHARED']
+
+
+# number of items looked at when estimating the size of a long container
+SAMPLE_SIZE = 100
+# number of evicted keys remembered to tell them apart from unknown keys
+EVICTED_MEMORY = 10000
+# keys that can be used as file names in the disk tier
+VALID_KEY = re.compile(r'^[\w\-]+$')
+EXTENSIONS = ('.npy', '.json')
+# share of the disk budget a trimmed disk tier is brought down to, so it isn't trimmed on every write
+DISK_TRIM_RATIO = 0.9
+# namespace of objects meant to be shared by all clients, it is never released
+SHARED = 'shared'
+# values that can't be changed in place, they don't need to be copied
+IMMUTABLE = (str, bytes, int, float, bool, complex, type(None))
+
+
+def sizeof(obj, depth=0):
+    """estimate the memory footprint of an object in bytes
+
+    Arrays report their exact ``nbytes``, containers are estimated from a sample of their items.
+    """
+    nbytes = getattr(obj, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+
+    size = sys.getsizeof(obj)
+    if depth > 8:
+        return size
+
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        items = obj if len(obj) <= SAMPLE_SIZE else list(obj)[:SAMPLE_SIZE]
+        if items:
+            sample = sum(sizeof(item, depth + 1) for item in items)
+            size += sample * len(obj) // len(items)
+    elif isinstance(obj, dict):
+        items = list(obj.items())
+        if len(items) > SAMPLE_SIZE:
+            items = items[:SAMPLE_SIZE]
+        if items:
+            sample = sum(sizeof(k, depth + 1) + sizeof(v, depth + 1) for k, v in items)
+            size += sample * len(obj) // len(items)
+    elif hasattr(obj, '__dict__') and not callable(obj):
+        size += sizeof(vars(obj), depth + 1)
+    return size
+
+
+def readonly(obj):
+    """return a version of a cached object that a function can use without changing the cached object
+
+    Arrays are returned as read-only views, lists, tuples and dicts are copied down to their
+    immutable items, other objects are deep-copied and callables are returned as they are.
+    """
+    if callable(obj) or isinstance(obj, IMMUTABLE):
+        return obj
+    if np is not None and isinstance(obj, np.ndarray):
+        view = obj.view()
+        view.flags.writeable = False
+        return view
+    if isinstance(obj, (list, tuple)):
+        if all(isinstance(item, IMMUTABLE) for item in obj):
+            return list(obj) if isinstance(obj, list) else obj
+        items = [readonly(item) for item in obj]
+        return items if isinstance(obj, list) else tuple(items)
+    if type(obj) is dict:
+        return dict((key, readonly(value)) for key, value in obj.items())
+    return copy.deepcopy(obj)
+
+
+class Cache(object):
+    """A store of cached objects with a byte budget and least-recently-used eviction.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The memory budget of the cache in bytes.
+        Default is ``None``, in which case the cache is unbounded.
+    directory : str, optional
+        A folder for the disk tier of the cache. Evicted entries are spilled to it instead of
+        being dropped, arrays as ``.npy`` files that are memory-mapped when loaded back and
+        other data as json. Entries found in the folder are served after a server restart.
+        Default is ``None``, in which case evicted entries are dropped.
+    write_through : bool, optional
+        Write every entry to the disk tier as soon as it is stored, so other processes
+        using the same folder can load it.
+        Default is ``False``.
+    max_disk_bytes : int, optional
+        The budget of the disk tier in bytes, beyond which the least recently used files are deleted.
+        Default is ``None``, in which case the disk tier is unbounded.
+
+    Notes
+    -----
+    Entries can be pinned to protect them from eviction, this is used for callbacks and
+    cached functions. Asking for an evicted entry raises a ``KeyError`` saying so.
+
+    """
+
+    def __init__(self, max_bytes=None, directory=None, write_through=False, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.write_through = write_through
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_bytes = 0
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.pinned = set()
+        self.evicted = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.loads = 0
+        self.misses = 0
+        self.lock = RLock()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if directory:
+            self.disk_bytes = sum(size for _, size, _ in self.disk_files())
+
+    def __contains__(self, key):
+        return key in self.items or self.find(key) is not None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key not in self.items:
+                path = self.find(key)
+                if path is not None:
+                    self.loads += 1
+                    return self.load(key, path)
+                self.misses += 1
+                if key in self.evicted:
+                    raise KeyError("Cached object {} has been evicted from the server cache, "
+                                   "please cache it again.".format(key))
+                raise KeyError("There is no cached object {} on the server.".format(key))
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, pin=False):
+        """store an object, evicting the least recently used entries when over budget"""
+        with self.lock:
+            self.discard(key)
+            self.items[key] = value
+            self.sizes[key] = sizeof(value)
+            self.nbytes += self.sizes[key]
+            self.evicted.pop(key, None)
+            if pin:
+                self.pinned.add(key)
+            if self.write_through:
+                self.spill(key, value)
+            self.evict(keep=key)
+
+    def pin(self, key):
+        """protect an entry from eviction"""
+        with self.lock:
+            if key not in self.items:
+                # raises if the entry is unknown, loads it into memory if it is on disk
+                self.__getitem__(key)
+            self.pinned.add(key)
+
+    def unpin(self, key):
+        """allow an entry to be evicted again"""
+        with self.lock:
+            self.pinned.discard(key)
+            self.evict()
+
+    def release(self, key):
+        """remove an entry on request of the client, including its copy on disk"""
+        with self.lock:
+            path = self.find(key)
+            if key not in self.items and path is None:
+                raise KeyError("There is no cached object {} on the server.".format(key))
+            self.discard(key)
+            if path is not None:
+                self.remove_file(path)
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.items:
+                del self.items[key]
+                self.nbytes -= self.sizes.pop(key)
+                self.pinned.discard(key)
+
+    def evict(self, keep=None):
+        """drop least recently used entries until the cache fits its budget, spilling them to disk if possible"""
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            for key in list(self.items):
+                if self.nbytes <= self.max_bytes:
+                    break
+                if key in self.pinned or key == keep:
+                    continue
+                if not self.spill(key, self.items[key]):
+                    self.evicted[key] = True
+                self.discard(key)
+            while len(self.evicted) > EVICTED_MEMORY:
+                self.evicted.popitem(last=False)
+
+    def stats(self):
+        """return the number and size of the entries in memory and the lookup counters"""
+        with self.lock:
+            return {'entries': len(self.items), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                    'pinned': len(self.pinned), 'hits': self.hits, 'loads': self.loads, 'misses': self.misses,
+                    'disk_bytes': self.disk_bytes, 'max_disk_bytes': self.max_disk_bytes}
+
+    def flush(self):
+        """write all entries that can be stored on disk, so they survive a restart"""
+        with self.lock:
+            for key, value in list(self.items.items()):
+                self.spill(key, value)
+
+    def path(self, key, extension):
+        if not self.directory or not isinstance(key, str) or not VALID_KEY.match(key):
+            return None
+        return os.path.join(self.directory, key + extension)
+
+    def find(self, key):
+        """return the path of the disk copy of an entry, or None"""
+        for extension in EXTENSIONS:
+            path = self.path(key, extension)
+            if path is not None and os.path.exists(path):
+                return path
+        return None
+
+    def spill(self, key, value):
+        """write an entry to the disk tier, returns False if it can not be stored there"""
+        if callable(value) or self.path(key, '') is None:
+            return False
+        if self.find(key) is not None:
+            return True
+
+        if np is not None and isinstance(value, np.ndarray) and value.dtype.kind in 'biufc':
+            path = self.path(key, '.npy')
+            write = lambda f: np.save(f, value, allow_pickle=False)
+        else:
+            try:
+                text = json.dumps(value, cls=DataEncoder).encode('utf-8')
+            except (TypeError, ValueError):
+                return False
+            path = self.path(key, '.json')
+            write = lambda f: f.write(text)
+
+        # write to a temporary file first, so other processes never see a partial entry
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'wb') as f:
+            write(f)
+        os.replace(temp, path)
+        self.disk_bytes += os.path.getsize(path)
+        if self.max_disk_bytes is not None and self.disk_bytes > self.max_disk_bytes:
+            self.trim_disk()
+        return True
+
+    def disk_files(self):
+        """list the entries of the disk tier as (last use, size, file name), including those of other processes"""
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(EXTENSIONS):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # removed by another process in the meantime
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        return files
+
+    def remove_file(self, path):
+        """delete a file of the disk tier, which another process may have deleted already"""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.disk_bytes -= size
+
+    def trim_disk(self):
+        """delete the least recently used files of the disk tier until it fits its budget"""
+        with self.lock:
+            files = sorted(self.disk_files())
+            self.disk_bytes = sum(size for _, size, _ in files)
+            for _, size, name in files:
+                if self.disk_bytes <= self.max_disk_bytes * DISK_TRIM_RATIO:
+                    break
+                key = os.path.splitext(name)[0]
+                if key in self.pinned:
+                    continue
+                self.remove_file(os.path.join(self.directory, name))
+                if key not in self.items:
+                    self.evicted[key] = True
+
+    def load(self, key, path):
+        """load an entry from disk back into memory, arrays are memory-mapped and don't count against the budget"""
+        try:
+            # the modification time tells the least recently used files when the disk tier is trimmed
+            os.utime(path, None)
+        except OSError:
+            pass
+        if path.endswith('.npy'):
+            value = np.load(path, mmap_mode='r')
+            size = 0
+        else:
+            with open(path, 'r') as f:
+                value = json.load(f, cls=DataDecoder)
+            size = sizeof(value)
+        self.items[key] = value
+        self.sizes[key] = size
+        self.nbytes += size
+        self.evict(keep=key)
+        return value
+
+
+class Memo(object):
+    """An index of memoized function results that are stored in a :class:`Cache`.
+
+    Parameters
+    ----------
+    cache : :class:`Cache`
+        The cache holding the results.
+    max_entries : int, optional
+        The maximum number of memoized results, the least recently used ones are dropped beyond it.
+        Default is ``128``.
+
+    """
+
+    def __init__(self, cache, max_entries=128):
+        self.cache = cache
+        self.max_entries = max_entries
+        self.keys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def lookup(self, key):
+        """return ``(True, result)`` if a result is memoized for key, ``(False, None)`` otherwise"""
+        with self.lock:
+            if key in self.cache:
+                self.keys[key] = True
+                self.keys.move_to_end(key)
+                self.hits += 1
+                return True, self.cache[key]
+            self.keys.pop(key, None)
+            self.misses += 1
+            return False, None
+
+    def store(self, key, result):
+        """memoize a result, dropping the oldest results beyond the entry limit"""
+        with self.lock:
+            self.cache.set(key, result)
+            self.keys[key] = True
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.max_entries:
+                old, _ = self.keys.popitem(last=False)
+                try:
+                    # including the copy in the disk tier, where lookup would find it again
+                    self.cache.release(old)
+                except KeyError:
+                    pass
+
+    def stats(self):
+        """return the hit and miss counters and the number of memoized results"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.keys), 'max_entries': self.max_entries}
+
+
+class Namespaces(object):
+    """An index of the client namespaces holding entries of a :class:`Cache`.
+
+    Parameters
+    ----------
+    cache : :class:`Cache`
+        The cache holding the entries.
+
+    Notes
+    -----
+    Entries are visible to the namespaces holding them and, through the ``SHARED`` namespace,
+    to everyone. Entries that are not indexed, like ones loaded from the disk tier after a restart,
+    are visible to all namespaces. When a namespace without open connections is released,
+    the entries no other namespace holds are removed from the cache.
+
+    Namespaces keep the references of different clients apart, they don't enforce access control:
+    the references are content hashes, and entries another worker process wrote to a shared disk tier
+    are not indexed here, so they are visible to all namespaces of this process.
+
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.owners = {}
+        self.keys = {}
+        self.connections = {}
+        self.lock = Lock()
+
+    def open(self, namespace):
+        """count a connection using a namespace"""
+        with self.lock:
+            self.connections[namespace] = self.connections.get(namespace, 0) + 1
+
+    def close(self, namespace):
+        """uncount a connection using a namespace, returns the number of connections still using it"""
+        with self.lock:
+            count = self.connections.get(namespace, 1) - 1
+            if count > 0 or namespace in self.keys:
+                self.connections[namespace] = count
+            else:
+                self.connections.pop(namespace, None)
+            return count
+
+    def add(self, namespace, key):
+        """record that a namespace holds an entry"""
+        with self.lock:
+            self.owners.setdefault(key, set()).add(namespace)
+            self.keys.setdefault(namespace, set()).add(key)
+
+    def visible(self, namespace, key):
+        """check if an entry can be used from a namespace"""
+        with self.lock:
+            owners = self.owners.get(key)
+            return owners is None or namespace in owners or SHARED in owners
+
+    def remove(self, namespace, key):
+        """drop an entry from a namespace, returns True if no namespace holds it anymore"""
+        with self.lock:
+            owners = self.owners.get(key)
+            if owners is None:
+                return True
+            owners.discard(namespace)
+            self.keys.get(namespace, set()).discard(key)
+            if owners:
+                return False
+            del self.owners[key]
+            return True
+
+    def release(self, namespace):
+        """remove the entries only held by a namespace from the cache, unless a connection uses it again"""
+        with self.lock:
+            if self.connections.get(namespace) or namespace == SHARED:
+                return []
+            self.connections.pop(namespace, None)
+            released = []
+            for key in self.keys.pop(namespace, ()):
+                owners = self.owners[key]
+                owners.discard(namespace)
+                if owners:
+                    continue
+                del self.owners[key]
+                try:
+                    self.cache.release(key)
+                except KeyError:
+                    # evicted in the meantime
+                    continue
+                released.append(key)
+            return released
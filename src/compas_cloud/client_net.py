@@ -3,13 +3,13 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
-import math
 
 from System import Array
 from System import ArraySegment
 from System import Byte
 from System import Uri
 from System import UriBuilder
+from System.IO import MemoryStream
 from System.Net.WebSockets import ClientWebSocket
 from System.Net.WebSockets import WebSocketCloseStatus
 from System.Net.WebSockets import WebSocketMessageType
@@ -21,8 +21,11 @@ from System.Threading import SemaphoreSlim
 
 import time
 
-SEND_CHUNK_SIZE = 1024
-RECEIVE_CHUNK_SIZE = 1024
+# the receive buffer starts at this size and doubles whenever a read fills it, up to the maximum
+RECEIVE_CHUNK_SIZE = 2**16
+MAX_RECEIVE_CHUNK_SIZE = 2**22
+# binary messages are byte strings in IronPython, latin-1 maps every character to the byte of the same value
+BYTE_ENCODING = Encoding.GetEncoding(28591)
 
 
 __all__ = ['Client_Net']
@@ -42,6 +45,12 @@ class Client_Net():
         The port number of remote server to connect to.
         Default is ``9000``.
 
+    Notes
+    -----
+    Received messages are collected in a single reusable memory stream and decoded once,
+    binary messages are returned as byte strings. The time the first part of the last message
+    arrived is kept as ``first_byte``.
+
     """
     def __init__(self, host='127.0.0.1', port=9000):
         """init the client, wait until it successfully connected to server"""
@@ -51,6 +60,9 @@ class Client_Net():
 
         self.token = CancellationTokenSource().Token
         self.socket = ClientWebSocket()
+        self.buffer = Array.CreateInstance(Byte, RECEIVE_CHUNK_SIZE)
+        self.stream = MemoryStream()
+        self.first_byte = None
         task = self.socket.ConnectAsync(uri, self.token)
         task.Wait()
         print('connected to cloud using .NET client!')
@@ -62,47 +74,48 @@ class Client_Net():
         task.Wait()
         print('closed!')
 
-    def send(self, payload):
-        """send a message to server and wait until sent"""
+    def send(self, payload, binary=False):
+        """send a message to server and wait until sent, binary messages are given as byte strings"""
         if self.socket.State != WebSocketState.Open:
             raise RuntimeError('Connection is not open.')
 
-        message_buffer = Encoding.UTF8.GetBytes(payload)
-        message_length = len(message_buffer)
-        chunks_count = int(math.ceil(float(message_length) / SEND_CHUNK_SIZE))
-        i = 0
+        if binary:
+            message_buffer = BYTE_ENCODING.GetBytes(payload)
+            message_type = WebSocketMessageType.Binary
+        else:
+            message_buffer = Encoding.UTF8.GetBytes(payload)
+            message_type = WebSocketMessageType.Text
 
-        while True:
-            # print('sending chunk', i)
-            offset = SEND_CHUNK_SIZE * i
-            is_last_message = (i == chunks_count - 1)
-
-            if is_last_message:
-                count = message_length - offset
-            else:
-                count = SEND_CHUNK_SIZE
-            message_chunk = ArraySegment[Byte](message_buffer, offset, count)
-            task = self.socket.SendAsync(
-                message_chunk, WebSocketMessageType.Text, is_last_message, self.token)
-            task.Wait()
-            i += 1
-
-            if is_last_message:
-                return True
+        # the socket frames the whole message itself, one call saves a round trip per chunk
+        task = self.socket.SendAsync(
+            ArraySegment[Byte](message_buffer), message_type, True, self.token)
+        task.Wait()
+        return True
 
     def receive(self):
-        """listen to a message until received one"""
+        """listen to a message until received one, returns the message and whether it was a binary frame"""
         if self.socket.State != WebSocketState.Open:
             raise RuntimeError('Connection is not open.')
 
-        chunks = []
+        self.stream.SetLength(0)
         while True:
-            # print('receive chunk')
-            buffer = Array.CreateInstance(Byte, RECEIVE_CHUNK_SIZE)
             task = self.socket.ReceiveAsync(
-                ArraySegment[Byte](buffer), self.token)
+                ArraySegment[Byte](self.buffer), self.token)
             task.Wait()
-            chunk = Encoding.UTF8.GetString(buffer)
-            chunks.append(chunk.rstrip('\x00'))
-            if task.Result.EndOfMessage:
-                return ''.join(chunks)
+            result = task.Result
+            if self.stream.Length == 0:
+                self.first_byte = time.time()
+            if result.MessageType == WebSocketMessageType.Close:
+                raise RuntimeError('Connection closed by server.')
+            self.stream.Write(self.buffer, 0, result.Count)
+            if result.EndOfMessage:
+                break
+            if result.Count == self.buffer.Length and self.buffer.Length < MAX_RECEIVE_CHUNK_SIZE:
+                self.buffer = Array.CreateInstance(Byte, self.buffer.Length * 2)
+
+        # decode the whole message at once, so characters split between reads stay intact
+        length = int(self.stream.Length)
+        # binary messages are byte strings under IronPython, only the frame type tells them apart from text
+        if result.MessageType == WebSocketMessageType.Binary:
+            return BYTE_ENCODING.GetString(self.stream.GetBuffer(), 0, length), True
+        return Encoding.UTF8.GetString(self.stream.GetBuffer(), 0, length), False
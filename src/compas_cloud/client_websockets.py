@@ -1,5 +1,7 @@
 import asyncio
+import queue
 import websockets
+from threading import Thread
 
 __all__ = ['Client_Websockets']
 
@@ -18,25 +20,73 @@ class Client_Websockets():
         The port number of remote server to connect to.
         Default is ``9000``.
 
+    compression : bool, optional
+        Negotiate permessage-deflate compression with the server.
+        Default is ``False``.
+
+    Notes
+    -----
+    The client owns an event loop running in a background thread, so it works inside
+    environments that already run a loop, like Jupyter, and can be used from several threads.
+    Incoming messages are read continuously and collected in an inbox queue.
+
     """
 
-    def __init__(self, host='127.0.0.1', port=9000):
+    def __init__(self, host='127.0.0.1', port=9000, compression=False):
         """init the client, wait until it successfully connected to server"""
+        self.inbox = queue.Queue()
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name='compas_cloud-client', daemon=True)
+        self.thread.start()
+
         async def connect():
             uri = "ws://{}:{}".format(host, str(port))
-            self.websocket = await websockets.connect(uri, max_size=2**30)
-        asyncio.get_event_loop().run_until_complete(connect())
+            self.websocket = await websockets.connect(uri, max_size=2**30,
+                                                    compression='deflate' if compression else None)
+        try:
+            self.run(connect())
+        except Exception:
+            self.stop()
+            raise
+        self.reader = asyncio.run_coroutine_threadsafe(self.read(), self.loop)
         print('connected to cloud using websockets client!')
 
-    def send(self, payload):
-        """send a message to server and wait until sent"""
+    def run(self, coroutine):
+        """run a coroutine on the event loop of the client and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def stop(self):
+        """stop the event loop of the client"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def read(self):
+        """put incoming messages into the inbox until the connection is closed"""
+        try:
+            async for message in self.websocket:
+                self.inbox.put(message)
+        finally:
+            self.inbox.put(None)
+
+    def disconnect(self):
+        """disconnect from server"""
+        self.run(self.websocket.close())
+        self.stop()
+        print('closed!')
+
+    def send(self, payload, binary=False):
+        """send a message to server and wait until sent, bytes are sent as a binary message"""
         async def _send():
             await self.websocket.send(payload)
             return True
-        return asyncio.get_event_loop().run_until_complete(_send())
+        return self.run(_send())
 
     def receive(self):
         """listen to a message until received one"""
-        async def _receive():
-            return await self.websocket.recv()
-        return asyncio.get_event_loop().run_until_complete(_receive())
+        message = self.inbox.get()
+        if message is None:
+            # leave the end marker for further calls
+            self.inbox.put(None)
+            raise RuntimeError('Connection is not open.')
+        return message
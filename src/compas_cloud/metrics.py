@@ -0,0 +1,214 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+from collections import deque
+from threading import Lock
+from threading import Thread
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+
+
+__all__ = ['Metrics', 'serve_metrics']
+
+
+PHASES = ('decode', 'execute', 'encode')
+QUANTILES = (0.5, 0.95, 0.99)
+# number of recent requests per function the percentiles are computed from
+WINDOW = 1000
+# number of functions recorded separately, requests of further functions are recorded together
+MAX_FUNCTIONS = 200
+OTHER = 'other'
+
+
+def percentiles(samples):
+    """return the nearest-rank percentiles of a sequence of samples"""
+    ordered = sorted(samples)
+    if not ordered:
+        return dict(('p{}'.format(int(q * 100)), None) for q in QUANTILES)
+    return dict(('p{}'.format(int(q * 100)), ordered[min(len(ordered) - 1, int(q * len(ordered)))])
+                for q in QUANTILES)
+
+
+def escape(value):
+    """escape a label value for the text exposition format of Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class FunctionMetrics(object):
+    """The counters and recent samples of the requests of one function or message type."""
+
+    def __init__(self, window=WINDOW):
+        self.count = 0
+        self.errors = 0
+        self.seconds = dict((phase, 0.0) for phase in PHASES)
+        self.samples = dict((phase, deque(maxlen=window)) for phase in PHASES)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.sizes = {'request': deque(maxlen=window), 'response': deque(maxlen=window)}
+
+    def add(self, timings, request_bytes, response_bytes, error):
+        self.count += 1
+        self.errors += int(error)
+        for phase, seconds in zip(PHASES, timings):
+            self.seconds[phase] += seconds
+            self.samples[phase].append(seconds)
+        self.request_bytes += request_bytes
+        self.response_bytes += response_bytes
+        self.sizes['request'].append(request_bytes)
+        self.sizes['response'].append(response_bytes)
+
+    def stats(self):
+        stats = {'count': self.count, 'errors': self.errors}
+        for phase in PHASES:
+            stats[phase] = percentiles(self.samples[phase])
+            stats[phase]['total'] = self.seconds[phase]
+        stats['request_bytes'] = percentiles(self.sizes['request'])
+        stats['request_bytes']['total'] = self.request_bytes
+        stats['response_bytes'] = percentiles(self.sizes['response'])
+        stats['response_bytes']['total'] = self.response_bytes
+        return stats
+
+
+class Metrics(object):
+    """Instrumentation of the requests handled by a server.
+
+    Parameters
+    ----------
+    window : int, optional
+        The number of recent requests per function that latency and size percentiles are computed from.
+        Default is ``1000``.
+    max_functions : int, optional
+        The number of functions recorded separately, the requests of further functions
+        are recorded together under ``other``.
+        Default is ``200``.
+
+    Notes
+    -----
+    Every request is recorded under the path of the function it calls, or under the kind of
+    message for other requests, with its decode, execute and encode time and its byte sizes.
+
+    """
+
+    def __init__(self, window=WINDOW, max_functions=MAX_FUNCTIONS):
+        self.window = window
+        self.max_functions = max_functions
+        self.functions = {}
+        self.in_flight = 0
+        self.started = time.time()
+        self.lock = Lock()
+
+    def begin(self):
+        """count a request that is being handled"""
+        with self.lock:
+            self.in_flight += 1
+
+    def end(self):
+        """uncount a request that has been handled"""
+        with self.lock:
+            self.in_flight -= 1
+
+    def record(self, name, timings, request_bytes, response_bytes, error=False):
+        """record the decode, execute and encode time in seconds and the byte sizes of a request"""
+        with self.lock:
+            if name not in self.functions:
+                if len(self.functions) >= self.max_functions:
+                    name = OTHER
+                if name not in self.functions:
+                    self.functions[name] = FunctionMetrics(self.window)
+            self.functions[name].add(timings, request_bytes, response_bytes, error)
+
+    def stats(self, cache=None, memo=None):
+        """return all metrics as a dictionary, including the statistics of given cache and memo"""
+        with self.lock:
+            stats = {'uptime': time.time() - self.started,
+                     'in_flight': self.in_flight,
+                     'functions': dict((name, f.stats()) for name, f in self.functions.items())}
+        if cache is not None:
+            stats['cache'] = cache.stats()
+        if memo is not None:
+            stats['memo'] = memo.stats()
+        return stats
+
+    def prometheus(self, cache=None, memo=None):
+        """return all metrics in the text exposition format of Prometheus"""
+        stats = self.stats(cache, memo)
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append('# HELP compas_cloud_{} {}'.format(name, description))
+            lines.append('# TYPE compas_cloud_{} {}'.format(name, kind))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label = ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels)
+                lines.append('compas_cloud_{}{} {}'.format(name, '{' + label + '}' if label else '', value))
+
+        functions = sorted(stats['functions'].items())
+        metric('uptime_seconds', 'gauge', 'Seconds since the server started.', [((), stats['uptime'])])
+        metric('in_flight_requests', 'gauge', 'Requests being handled.', [((), stats['in_flight'])])
+        metric('requests_total', 'counter', 'Handled requests.',
+               [((('function', name),), f['count']) for name, f in functions])
+        metric('request_errors_total', 'counter', 'Requests that failed.',
+               [((('function', name),), f['errors']) for name, f in functions])
+
+        samples = []
+        for name, f in functions:
+            for phase in PHASES:
+                for q in QUANTILES:
+                    labels = (('function', name), ('phase', phase), ('quantile', q))
+                    samples.append((labels, f[phase]['p{}'.format(int(q * 100))]))
+        metric('duration_seconds', 'summary', 'Time spent decoding, executing and encoding requests.', samples)
+        for name, f in functions:
+            for phase in PHASES:
+                labels = 'function="{}",phase="{}"'.format(escape(name), phase)
+                lines.append('compas_cloud_duration_seconds_sum{{{}}} {}'.format(labels, f[phase]['total']))
+                lines.append('compas_cloud_duration_seconds_count{{{}}} {}'.format(labels, f['count']))
+
+        metric('request_bytes_total', 'counter', 'Bytes received in requests.',
+               [((('function', name),), f['request_bytes']['total']) for name, f in functions])
+        metric('response_bytes_total', 'counter', 'Bytes sent in responses.',
+               [((('function', name),), f['response_bytes']['total']) for name, f in functions])
+
+        if 'cache' in stats:
+            cache = stats['cache']
+            metric('cache_entries', 'gauge', 'Objects in memory in the cache.', [((), cache['entries'])])
+            metric('cache_bytes', 'gauge', 'Estimated size of the objects in memory in the cache.',
+                   [((), cache['bytes'])])
+            metric('cache_hits_total', 'counter', 'Cached objects served from memory.', [((), cache['hits'])])
+            metric('cache_loads_total', 'counter', 'Cached objects loaded from the disk tier.', [((), cache['loads'])])
+            metric('cache_misses_total', 'counter', 'Requests of unknown or evicted objects.', [((), cache['misses'])])
+        if 'memo' in stats:
+            memo = stats['memo']
+            metric('memo_hits_total', 'counter', 'Calls answered with a memoized result.', [((), memo['hits'])])
+            metric('memo_misses_total', 'counter', 'Memoized calls that had to be executed.', [((), memo['misses'])])
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(port, render, host='127.0.0.1'):
+    """serve the text returned by render over http in a background thread, returns the http server"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = Thread(target=server.serve_forever, name='compas_cloud-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -7,11 +7,20 @@ import json
 from compas.utilities import DataEncoder
 from compas.utilities import DataDecoder
 
+from .serialization import dumps_binary
+from .serialization import loads_binary
+from .serialization import content_key
+from .serialization import shared_memory_available
+from .serialization import create_probe
+from .serialization import release_segments
+from .tracing import Tracer
+
 import compas
 import os
 
 import time
 import inspect
+import uuid
 
 from subprocess import Popen
 from subprocess import PIPE
@@ -25,8 +34,13 @@ else:
 
 __all__ = ['Proxy']
 
+# a server is only started by the proxy if it is meant to run on this machine
+LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
 from functools import wraps
-def retry_if_exception(ex, max_retries, wait = 0):
+from collections import deque
+from threading import Condition
+def retry_if_exception(ex, max_retries, wait = 0, tracer=None, name=None):
     def outer(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
@@ -36,6 +50,7 @@ def retry_if_exception(ex, max_retries, wait = 0):
             while x:
                 if compas.IPY:
                     Rhino.RhinoApp.Wait()
+                start = time.time()
                 try:
                     return func(*args, **kwargs)
                 except ex as error:
@@ -46,6 +61,8 @@ def retry_if_exception(ex, max_retries, wait = 0):
                     print('proxy call failed, trying time left:',x)
                     x -= 1
                     time.sleep(wait)
+                    if tracer is not None:
+                        tracer.retry(name or func.__name__, max_retries - x, start, time.time(), e)
             raise e
         return wrapper
     return outer
@@ -53,6 +70,144 @@ def retry_if_exception(ex, max_retries, wait = 0):
 class ServerSideError(Exception):
     pass
 
+
+class Future():
+    """A handle to the result of a request that has been sent but is maybe not answered yet.
+
+    Parameters
+    ----------
+    proxy : :class:`Proxy`
+        The proxy the request was sent through.
+    request_id : int
+        The id of the request.
+
+    """
+
+    def __init__(self, proxy, request_id):
+        self.proxy = proxy
+        self.request_id = request_id
+        self._done = False
+        self._result = None
+
+    def done(self):
+        """check if the result has already been received"""
+        return self._done or self.request_id in self.proxy.responses
+
+    def result(self):
+        """wait for the result, raise a ServerSideError if the call failed on server side"""
+        if not self._done:
+            self._result = self.proxy.wait(self.request_id)
+            self._done = True
+        if isinstance(self._result, dict) and 'error' in self._result:
+            raise ServerSideError("".join(self._result['error']))
+        return self.proxy.annotate(self._result)
+
+
+class RemoteIterator():
+    """An iterator over the items of a generator that is kept alive on the server.
+
+    Parameters
+    ----------
+    proxy : :class:`Proxy`
+        The proxy connected to the server holding the generator.
+    reference : dict
+        The handle of the generator returned by the server.
+    chunk_size : int, optional
+        The number of items pulled from the server per request.
+        Default is ``1``.
+    prefetch : int, optional
+        The number of requests kept in flight ahead of the items being consumed.
+        Default is ``1``.
+
+    """
+
+    def __init__(self, proxy, reference, chunk_size=1, prefetch=1):
+        self.proxy = proxy
+        self.reference = reference
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.pending = deque()
+        self.received = {}
+        self.items = deque()
+        self.position = 0
+        self.exhausted = False
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __next__(self):
+        while not self.items:
+            if self.closed:
+                raise StopIteration
+            if self.position in self.received:
+                batch = self.received.pop(self.position)
+                self.items.extend(batch)
+                self.position += len(batch)
+                continue
+            self.request()
+            if not self.pending:
+                self.close()
+                raise StopIteration
+            try:
+                result = self.pending.popleft().result()
+            except Exception:
+                self.close()
+                raise
+            self.received[result['start']] = result['items']
+            if result['done']:
+                self.exhausted = True
+        return self.items.popleft()
+
+    next = __next__
+
+    def request(self):
+        """send requests for further items until enough are in flight"""
+        while not self.exhausted and len(self.pending) <= self.prefetch:
+            idict = {'next': self.reference['iterator'], 'count': self.chunk_size}
+            self.pending.append(Future(self.proxy, self.proxy.post(idict)))
+
+    def close(self):
+        """release the generator on the server, without waiting for the items still in flight"""
+        if not self.closed:
+            self.closed = True
+            for future in self.pending:
+                self.proxy.cancel(future.request_id)
+            self.pending.clear()
+            self.received.clear()
+            self.items.clear()
+            self.proxy.cancel(self.proxy.post({'close_iterator': self.reference['iterator']}))
+
+
+def _find_server(obj):
+    """return the server owning the first cached object referenced in obj, or None"""
+    if isinstance(obj, dict):
+        if 'cached' in obj and 'server' in obj:
+            return obj['server']
+        items = obj.values()
+    elif isinstance(obj, (list, tuple)) and obj and not isinstance(obj[0], (int, float)):
+        items = obj
+    else:
+        return None
+    for item in items:
+        server = _find_server(item)
+        if server is not None:
+            return server
+    return None
+
+
 class Proxy():
     """Proxy is the interface between the user and a websocket client which communicates to websoket server in background.
 
@@ -61,10 +216,59 @@ class Proxy():
     port : int, optional
         The port number on the remote server.
         Default is ``9000``.
+    binary : bool, optional
+        Send messages as binary frames, with numpy arrays and lists of floats
+        transported as raw buffers instead of json text.
+        Default is ``False``.
+    shared_memory : bool, optional
+        In binary mode, exchange large arrays through shared memory segments
+        if the server runs on the same host, which is checked when connecting.
+        Default is ``True``.
+    cache_dir : str, optional
+        Folder for the disk tier of the server cache, passed to servers started by the proxy.
+        Cached objects written there survive a restart of the server.
+        Default is ``None``.
+    compression : bool, optional
+        Compress messages with permessage-deflate, which pays off for remote servers.
+        The server leaves messages below its ``--compress-threshold`` uncompressed.
+        Not supported by the .NET client.
+        Default is ``False``.
+    session : str, optional
+        A name for the namespace of the objects cached through this proxy on the server.
+        Objects are released a while after the last connection using the namespace closed,
+        a proxy reconnecting with the same session name within that time keeps them.
+        Default is ``None``, in which case each connection has a namespace of its own,
+        except for the connections of a pool, which share a generated session name.
+    workers : int, optional
+        The number of processes of a server started by the proxy, see ``--workers`` of the server.
+        Default is ``1``.
+    trace : bool, optional
+        Record the time spent encoding, sending, waiting for, receiving and decoding each call,
+        see :meth:`Proxy.dump_trace`.
+        Default is ``False``.
+    hosts : list, optional
+        Spread calls over several servers, given as ``'host:port'`` strings or ``(host, port)`` tuples.
+        Default is ``None``, in which case the proxy connects to ``host`` and ``port``.
+    pool_size : int, optional
+        The number of connections opened to each of the ``hosts``.
+        Default is ``1``.
+    routing : {'least_outstanding', 'round_robin'}, optional
+        How calls are assigned to the connections of the pool.
+        Default is ``'least_outstanding'``.
 
     Notes
     -----
 
+    Every message carries a request id that the server sends back with the result,
+    so several calls can be in flight over the same connection at once.
+    ``proxy.submit`` or functions created with ``async_=True`` return a :class:`Future`
+    instead of waiting for the result.
+    Calls can also be made from several threads, each waits for the results of its own requests.
+
+    With ``hosts``, the proxy keeps a pool of connections and sends each call to the connection
+    with the fewest unanswered requests, or to the next one in turn. References to cached objects
+    remember the server holding the object, calls using them are sent to that server.
+
     The service will make the correct (version of the requested) functionality available
     even if that functionality is part of a virtual environment. This is because it
     will use the specific python interpreter for which the functionality is installed to
@@ -84,86 +288,323 @@ class Proxy():
         p = Proxy()
         dr_numpy = p.package('compas.numerical.dr_numpy')
 
+        dot = p.function('numpy.dot', async_=True)
+        futures = [dot(a, b) for a, b in pairs]
+        results = [f.result() for f in futures]
+
 
     """
 
-    def __init__(self, host='127.0.0.1', port=9000, background=True, errorHandler=None):
+    def __init__(self, host='127.0.0.1', port=9000, background=True, errorHandler=None, binary=False, shared_memory=True,
+                 cache_dir=None, compression=False, session=None, workers=1, trace=False, hosts=None, pool_size=1,
+                 routing='least_outstanding'):
         """init function that starts a remote server then assigns corresponding client(websockets/.net) to the proxy"""
+        if compression and compas.IPY:
+            raise ValueError("Compression is not supported by the .NET client.")
         self._python = compas._os.select_python(None)
         self.host = host
         self.port = port
         self.background = background
+        self.binary = binary
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.session = session
+        self.compression = compression
+        self.callbacks = {}
+        self.responses = {}
+        self.segments = {}
+        self.cancelled = set()
+        self.request_id = 0
+        self.pending = set()
+        self.condition = Condition()
+        self.receiving = False
+        self.errorHandler = errorHandler
+        self.tracer = Tracer() if trace else None
+        self.address = None
+        self.pool = None
+        self.routing = routing
+        self.turn = 0
+        if hosts:
+            self.client = None
+            self.shared_memory = False
+            self.pool = []
+            # the connections to the same server share a namespace, so any of them can use a reference
+            self.session = session = session or 'pool-' + uuid.uuid4().hex
+            for address in hosts:
+                if isinstance(address, str):
+                    address = address.split(':')
+                host = address[0]
+                port = int(address[1]) if len(address) > 1 else port
+                for _ in range(pool_size):
+                    member = Proxy(host, port, background, None, binary, shared_memory, cache_dir, compression, session,
+                                   workers)
+                    member.address = '{}:{}'.format(host, port)
+                    member.tracer = self.tracer
+                    self.pool.append(member)
+            return
         self.client = self.try_reconnect()
         if not self.client:
             self.client = self.start_server()
-        self.callbacks = {}
-        self.errorHandler = errorHandler
+        self.use_shared_memory = shared_memory
+        self.negotiate_shared_memory()
+        self.join_session()
 
     def package(self, function, cache=False):
         raise RuntimeError("Proxy.package() has been deprecated, please use Proxy.function() instead.")
         
 
-    def function(self, function, cache=False):
-        """returns wrapper of function that will be executed on server side"""
+    def function(self, function, cache=False, async_=False, memoize=False, stream=False, chunk_size=None,
+                 prefetch=1):
+        """returns wrapper of function that will be executed on server side
+
+        With ``memoize=True`` the server keeps the results and returns them for repeated calls
+        with the same arguments without executing the function again.
+
+        With ``stream=True`` the wrapper returns a :class:`RemoteIterator` over chunks of the result,
+        which the server keeps until they are pulled: slices of ``chunk_size`` rows of an array or list,
+        or the items produced by a generator function, with ``prefetch`` chunks requested ahead.
+        A streamed result can't be cached.
+
+        Without streaming, a generator function returns a :class:`RemoteIterator` that pulls
+        ``chunk_size`` items per request from the generator kept on the server,
+        with ``prefetch`` requests sent ahead.
+        """
+        if stream and cache:
+            # the server keeps a cached result whole and only returns its reference
+            raise ValueError("A streamed result can't be cached, use either stream=True or cache=True.")
+
+        def submit_function(*args, **kwargs):
+            return self.call(function, args, kwargs, cache=cache, memoize=memoize,
+                             stream=stream, chunk_size=chunk_size)
+
+        if stream:
+            def stream_function(*args, **kwargs):
+                future = submit_function(*args, **kwargs)
+                return future.proxy.iter_chunks(future, prefetch)
+
+            return stream_function
+
+        if async_:
+            return submit_function
+
+        def result_of(future):
+            result = future.result()
+            if isinstance(result, dict) and 'iterator' in result:
+                return RemoteIterator(future.proxy, result, chunk_size or 1, prefetch)
+            return result
 
         if self.errorHandler:
             @self.errorHandler
-            @retry_if_exception(Exception, 5, wait = 0.5)
+            @retry_if_exception(Exception, 5, wait = 0.5, tracer=self.tracer, name=function)
             def run_function(*args, **kwargs):
-                return self.run(function, cache, *args, **kwargs)
+                return result_of(submit_function(*args, **kwargs))
 
             return run_function
         else:
-            @retry_if_exception(Exception, 5, wait = 0.5)
+            @retry_if_exception(Exception, 5, wait = 0.5, tracer=self.tracer, name=function)
             def run_function(*args, **kwargs):
-                return self.run(function, cache, *args, **kwargs)
+                return result_of(submit_function(*args, **kwargs))
             
             return run_function
 
     def send(self, data):
         """encode given data before sending to remote server then parse returned result"""
+        if self.pool:
+            # sessions live on the first server, like the functions cached for them
+            member = self.pool[0] if 'sessions' in data else self.select(data)
+            return member.send(data)
         if not self.client:
             print("There is no connected client, try to restart proxy")
             return
-        
-        istring = json.dumps(data, cls=DataEncoder)
-        self.client.send(istring)
-
-        def listen_and_parse():
-            result = self.client.receive()
-            return json.loads(result, cls=DataDecoder)
-
-        result = listen_and_parse()
-        # keep receiving response until a non-callback result is returned
-        while True:
-            if isinstance(result, dict):
-                if 'callback' in result:
-                    cb = result['callback']
-                    self.callbacks[cb['id']](*cb['args'], **cb['kwargs'])
-                    result = listen_and_parse()
-                elif 'listen' in result:
-                    print(*result['listen'])
-                    result = listen_and_parse()
-                else:
-                    break
-            else:
-                break
-
+        return self.wait(self.post(data))
+
+    def post(self, data):
+        """send data tagged with a new request id without waiting for the result, returns the request id"""
+        with self.condition:
+            self.request_id += 1
+            request_id = data['request_id'] = self.request_id
+            self.pending.add(request_id)
+        segments = []
+        try:
+            self.send_only(data, segments)
+        except Exception:
+            release_segments(segments)
+            raise
+        if segments:
+            # released once the response shows that the server is done with the arguments
+            with self.condition:
+                self.segments[request_id] = segments
+        return request_id
+
+    def wait(self, request_id):
+        """receive messages until the result of given request arrives, results of other requests are kept"""
+        while self.pump(lambda: request_id in self.responses):
+            pass
+        with self.condition:
+            return self.responses.pop(request_id)
+
+    def pump(self, ready):
+        """receive and handle one message unless ready() is true, returns False once it is
+
+        Only one thread receives at a time, the others wait for it to handle its message
+        and check again whether the message they wait for has arrived.
+        """
+        with self.condition:
+            if ready():
+                return False
+            if self.receiving:
+                self.condition.wait()
+                return True
+            self.receiving = True
+        try:
+            self.listen_and_parse()
+        finally:
+            with self.condition:
+                self.receiving = False
+                self.condition.notify_all()
+        return True
+
+    def listen_and_parse(self):
+        """receive and handle one message: run callbacks, print logs or store results by request id"""
+        if self.tracer is None:
+            message = self.decode(*self.receive())
+        else:
+            raw, binary = self.receive()
+            received = time.time()
+            message = self.decode(raw, binary)
+            # only the .NET client knows when the first frame of a message arrived
+            first_byte = getattr(self.client, 'first_byte', None)
+            self.tracer.received(id(self), message, first_byte, received, time.time(), len(raw))
+
+        if isinstance(message, dict):
+            if 'callback' in message:
+                cb = message['callback']
+                self.callbacks[cb['id']](*cb['args'], **cb['kwargs'])
+                return
+            if 'listen' in message:
+                print(*message['listen'])
+                return
+            if 'request_id' in message:
+                with self.condition:
+                    if message['request_id'] in self.cancelled:
+                        self.cancelled.discard(message['request_id'])
+                    else:
+                        self.responses[message['request_id']] = message['result']
+                    self.pending.discard(message['request_id'])
+                    segments = self.segments.pop(message['request_id'], None)
+                if segments:
+                    release_segments(segments)
+                return
+            if 'error' in message:
+                # the server couldn't even read the id of the request, so it can't tell which one failed
+                raise ServerSideError("".join(message['error']))
+        raise RuntimeError("Received a message without request id, the server might be outdated.")
+
+    def send_only(self, data, segments=None):
+        if self.tracer is None:
+            return self.client.send(self.encode(data, segments), self.binary)
+        start = time.time()
+        message = self.encode(data, segments)
+        encoded = time.time()
+        result = self.client.send(message, self.binary)
+        self.tracer.sent(id(self), data, start, encoded, time.time(), len(message))
         return result
 
-    def send_only(self, data):
-        istring = json.dumps(data, cls=DataEncoder)
-        return self.client.send(istring)
+    def dump_trace(self, path):
+        """write the calls traced by the proxy to a json file in the Chrome trace event format"""
+        if self.tracer is None:
+            raise RuntimeError("Tracing is not enabled, create the proxy with trace=True.")
+        self.tracer.dump(path)
+
+    def encode(self, data, segments=None):
+        """encode data into a text or binary message depending on the transport mode
+
+        Names of the shared memory segments created for the message are added to ``segments``.
+        """
+        if self.binary:
+            return dumps_binary(data, self.shared_memory, segments)
+        return json.dumps(data, cls=DataEncoder)
+
+    def receive(self):
+        """receive a message from the client, returns the message and whether it is binary"""
+        if compas.IPY:
+            # the .NET client reports the frame type, its byte strings can't be told apart from text
+            return self.client.receive()
+        message = self.client.receive()
+        return message, isinstance(message, bytes)
+
+    def decode(self, message, binary=None):
+        """decode a received message, binary messages arrive as bytes unless told otherwise"""
+        if binary is None:
+            binary = isinstance(message, bytes)
+        if binary:
+            return loads_binary(message)
+        return json.loads(message, cls=DataDecoder)
 
     def run(self, package, cache, *args, **kwargs):
         """pass the arguments to remote function and wait to receive the results"""
+        return self.run_async(package, cache, *args, **kwargs).result()
+
+    def run_async(self, package, cache, *args, **kwargs):
+        """pass the arguments to remote function and return a future of the results"""
+        return self.call(package, args, kwargs, cache=cache)
+
+    def call(self, package, args, kwargs, cache=False, memoize=False, stream=False, chunk_size=None):
+        """send a function call with its options to the server and return a future of the results"""
+        if self.pool:
+            member = self.select((args, kwargs))
+            return member.call(package, args, kwargs, cache, memoize, stream, chunk_size)
         args, kwargs = self.parse_callbacks(args, kwargs)
         idict = {'package': package, 'cache': cache,
                  'args': args, 'kwargs': kwargs}
-        result = self.send(idict)
-        if 'error' in result:
-            raise ServerSideError("".join(result['error']))
-        return result
+        if memoize:
+            idict['memoize'] = True
+        if stream:
+            idict['stream'] = True
+            idict['chunk_size'] = chunk_size
+        return Future(self, self.post(idict))
+
+    def iter_chunks(self, future, prefetch=1):
+        """return an iterator that pulls the chunks of a streamed result from the server"""
+        return RemoteIterator(future.proxy, future.result(), 1, prefetch)
+
+    def cancel(self, request_id):
+        """stop waiting for the result of a request, it is dropped when it arrives"""
+        with self.condition:
+            if self.responses.pop(request_id, None) is None and request_id in self.pending:
+                self.cancelled.add(request_id)
+
+    def map(self, function, iterable, cache=False):
+        """call a function on server side once for each tuple of positional arguments in iterable.
+
+        All calls are packed into a single message and executed by the server in one pass,
+        the list of results is returned in the same order.
+        With a pool of servers, the calls are split into one message per connection.
+        """
+        groups = {}
+        calls = []
+        for i, args in enumerate(iterable):
+            member = self.select(args) if self.pool else self
+            groups.setdefault(member, []).append(i)
+            calls.append({'package': function, 'cache': cache, 'args': list(args), 'kwargs': {}})
+
+        futures = []
+        for member, indices in groups.items():
+            batch = [calls[i] for i in indices]
+            futures.append((indices, Future(member, member.post({'batch': batch}))))
+        results = [None] * len(calls)
+        for indices, future in futures:
+            for i, result in zip(indices, future.result()):
+                results[i] = future.proxy.annotate(result)
+
+        for result in results:
+            if isinstance(result, dict) and 'error' in result:
+                raise ServerSideError("".join(result['error']))
+        return results
+
+    def submit(self, function, *args, **kwargs):
+        """call a function on server side without waiting, returns a future of its result"""
+        return self.run_async(function, False, *args, **kwargs)
 
     def Sessions(self, *args, **kwargs):
         return Sessions_client(self, *args, **kwargs)
@@ -175,18 +616,85 @@ class Proxy():
 
     def get(self, cached_object):
         """get content of a cached object stored remotely"""
+        if self.pool:
+            return self.select(server=cached_object['server']).get(cached_object)
         idict = {'get': cached_object['cached']}
         return self.send(idict)
 
-    def cache(self, data):
-        """cache data or function to remote server and return a reference of it"""
+    def cache(self, data, pin=False, scope=None):
+        """cache data or function to remote server and return a reference of it, pinned data is never evicted.
+
+        Data is referenced by a hash of its content,
+        it is only uploaded if the server doesn't have it cached already.
+        With a pool of servers, the hash also decides which server holds the data.
+        Data cached with ``scope='shared'`` is visible to all clients and kept when this proxy disconnects.
+        """
+        if callable(data) and self.pool:
+            return self.pool[0].cache(data)
+
         if callable(data):
             idict = {'cache_func': {
                 'name': data.__name__,
                 'source': inspect.getsource(data)
             }}
-        else:
-            idict = {'cache': data}
+            return self.send(idict)
+
+        try:
+            key = content_key(data)
+        except (TypeError, ValueError):
+            key = None
+
+        member = self
+        if self.pool:
+            servers = sorted(set(m.address for m in self.pool))
+            member = self.select(server=servers[int(key, 16) % len(servers)] if key else None)
+
+        if key is not None:
+            result = member.send({'cache_key': key, 'pin': pin, 'scope': scope})
+            if 'missing' not in result:
+                return member.annotate(result)
+        idict = {'cache': data, 'key': key, 'pin': pin, 'scope': scope}
+        return member.annotate(member.send(idict))
+
+    def annotate(self, result):
+        """add the address of the server to a reference of a cached object, if this proxy is part of a pool"""
+        if self.address and isinstance(result, dict) and 'cached' in result:
+            result['server'] = self.address
+        return result
+
+    def select(self, objects=(), server=None):
+        """choose a connection of the pool, to the server owning the cached objects referenced in objects if any"""
+        server = server or _find_server(objects)
+        members = self.pool
+        if server is not None:
+            members = [member for member in self.pool if member.address == server]
+            if not members:
+                raise ValueError("The server {} holding a cached object is not part of the pool.".format(server))
+        with self.condition:
+            self.turn += 1
+            start = self.turn % len(members)
+        members = members[start:] + members[:start]
+        if self.routing == 'round_robin':
+            return members[0]
+        return min(members, key=lambda member: len(member.pending))
+
+    def servers(self):
+        """return one connection of the pool to each server"""
+        members = {}
+        for member in self.pool:
+            members.setdefault(member.address, member)
+        return [members[address] for address in sorted(members)]
+
+    def broadcast(self, data):
+        """send data to every server of the pool, returns the results by server address"""
+        futures = [Future(member, member.post(dict(data))) for member in self.servers()]
+        return dict((future.proxy.address, future.proxy.wait(future.request_id)) for future in futures)
+
+    def release(self, cached_object):
+        """remove a cached object from the remote server"""
+        if self.pool:
+            return self.select(server=cached_object['server']).release(cached_object)
+        idict = {'release': cached_object['cached']}
         return self.send(idict)
 
     def parse_callbacks(self, args, kwargs):
@@ -203,10 +711,36 @@ class Proxy():
                 self.callbacks[id(cb)] = cb
         return args, kwargs
 
+    def join_session(self):
+        """use the named session as namespace for the objects cached on the server"""
+        if self.session is not None:
+            self.send({'control': 'session', 'name': self.session})
+
+    def negotiate_shared_memory(self):
+        """check if the server can attach to shared memory segments created by this process and use them if so"""
+        self.shared_memory = False
+        if not (self.binary and self.use_shared_memory and shared_memory_available()):
+            return
+        if self.host not in LOCAL_HOSTS:
+            return
+        probe = create_probe()
+        try:
+            result = self.send({'control': 'shared_memory', 'probe': probe.name, 'value': probe.buf[0]})
+        finally:
+            probe.close()
+            probe.unlink()
+        self.shared_memory = result is True
+
+    def connect(self):
+        """create a client connected to the server"""
+        if self.compression:
+            return Client(self.host, self.port, compression=True)
+        return Client(self.host, self.port)
+
     def try_reconnect(self):
         """try to reconnect to a existing server"""
         try:
-            client = Client(self.host, self.port)
+            client = self.connect()
         except Exception:
             return None
         else:
@@ -215,9 +749,17 @@ class Proxy():
 
     def start_server(self):
         """use Popen to start a remote server in background"""
+        if self.host not in LOCAL_HOSTS:
+            # a server started here would listen on this machine, not at the requested host
+            raise RuntimeError("Could not connect to the server at {}:{}, it has to be started on that machine."
+                               .format(self.host, self.port))
         env = compas._os.prepare_environment()
 
         args = [self._python, '-m', 'compas_cloud.server', str(self.port)]
+        if self.cache_dir:
+            args += ['--cache-dir', self.cache_dir]
+        if self.workers > 1:
+            args += ['--workers', str(self.workers)]
 
         if self.background:
             print("Starting new cloud server in background at {}:{}".format(self.host, self.port))
@@ -237,7 +779,7 @@ class Proxy():
                     Rhino.RhinoApp.Wait()
             try:
                 time.sleep(0.2)
-                client = Client(self.host, self.port)
+                client = self.connect()
             except Exception as e:
 
                 # stop trying if the subprocess is not running anymore
@@ -265,29 +807,68 @@ class Proxy():
 
     def restart(self):
         """shut down and restart existing server and given ip and port"""
+        if self.pool:
+            raise RuntimeError("A pool of servers can't be restarted from the proxy.")
         self.client = self.try_reconnect()
         self.shutdown()
         time.sleep(1)
         self.client = self.start_server()
+        self.negotiate_shared_memory()
+        self.join_session()
 
     def shutdown(self):
         """shut down currently connected server"""
-        if self.client:
+        if self.pool:
+            for member in self.servers():
+                member.shutdown()
+        elif self.client:
             if self.send_only({'control': 'shutdown'}):
                 self.client = None
+                # arguments of requests that will never be answered
+                for segments in self.segments.values():
+                    release_segments(segments)
+                self.segments.clear()
                 print("server will shutdown and proxy client disconnected.")
         else:
             print("there is already no connected client")
 
     def check(self):
         """check if server connection is good"""
+        if self.pool:
+            return self.broadcast({'control': 'check'})
         return self.send({'control': 'check'})
 
+    def preload(self, modules):
+        """import given modules on server side and register their functions ahead of the first call"""
+        if self.pool:
+            return self.broadcast({'control': 'preload', 'modules': list(modules)})
+        return self.send({'control': 'preload', 'modules': list(modules)})
+
+    def registry(self):
+        """list the function paths already resolved by the server"""
+        if self.pool:
+            return self.broadcast({'control': 'registry'})
+        return self.send({'control': 'registry'})
+
+    def stats(self):
+        """get the request metrics and cache statistics of the server"""
+        if self.pool:
+            return self.broadcast({'control': 'stats'})
+        return self.send({'control': 'stats'})
+
+    def memo_stats(self):
+        """get the hit and miss counters of memoized function results on the server"""
+        if self.pool:
+            return self.broadcast({'control': 'memo'})
+        return self.send({'control': 'memo'})
+
 
 class Sessions_client():
 
     def __init__(self, proxy, *args, **kwargs):
         self.proxy = proxy
+        self.results = {}
+        self.errors = {}
         idict = {'sessions': {'command': 'create', 'args': args, 'kwargs': kwargs}}
         print(self.proxy.send(idict))
 
@@ -301,8 +882,14 @@ class Sessions_client():
         print(self.proxy.send(idict))
 
     def listen(self):
+        """listen to the tasks until all finished, then keep the references to their results cached on the server"""
         idict = {'sessions': {'command': 'listen', 'args': (), 'kwargs': {}}}
-        print(self.proxy.send(idict))
+        concluded = self.proxy.send(idict)
+        if 'error' in concluded:
+            raise ServerSideError("".join(concluded['error']))
+        self.results = dict((int(task_id), cached) for task_id, cached in concluded['results'].items())
+        self.errors = dict((int(task_id), error) for task_id, error in concluded['errors'].items())
+        print("All sessions concluded")
 
     def terminate(self):
         pass
@@ -0,0 +1,337 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import array
+import json
+import os
+import struct
+import sys
+from itertools import chain
+
+try:
+    from hashlib import blake2b as hash_function
+except ImportError:
+    from hashlib import sha256 as hash_function
+
+from compas.utilities import DataEncoder
+from compas.utilities import DataDecoder
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+__all__ = ['dumps_binary', 'loads_binary', 'loads_header', 'content_key', 'shared_memory_available', 'create_probe', 'check_probe',
+           'release_segments', 'live_segments']
+
+
+# lists with fewer floats than this stay in the json header, where they are cheaper
+BUFFER_THRESHOLD = 64
+BUFFER_ALIGNMENT = 8
+BUFFER_KEY = '__buffer__'
+# buffers from this size on go through shared memory when it is enabled
+SHARED_MEMORY_THRESHOLD = 2**20
+
+# array.array typecodes for buffer formats, used when numpy is not available
+TYPECODES = {'f8': 'd', 'f4': 'f', 'i8': 'q', 'i4': 'i', 'i2': 'h', 'i1': 'b',
+             'u8': 'Q', 'u4': 'I', 'u2': 'H', 'u1': 'B'}
+
+
+def _float_shape(value):
+    """return the shape of a rectangular nested list of floats, or None"""
+    if not value:
+        return None
+    first = value[0]
+    if isinstance(first, float):
+        for v in value:
+            if not isinstance(v, float):
+                return None
+        return [len(value)]
+    if isinstance(first, (list, tuple)):
+        inner = _float_shape(first)
+        if inner is None:
+            return None
+        for v in value:
+            if not isinstance(v, (list, tuple)) or _float_shape(v) != inner:
+                return None
+        return [len(value)] + inner
+    return None
+
+
+def _flatten(value, depth):
+    for _ in range(depth - 1):
+        value = chain.from_iterable(value)
+    return value
+
+
+def _tobytes(a):
+    if hasattr(a, 'tobytes'):
+        return a.tobytes()
+    return a.tostring()
+
+
+class _Packer(object):
+    """collect array buffers from a data tree and replace them with placeholders"""
+
+    def __init__(self, shared=False):
+        self.buffers = []
+        self.size = 0
+        self.shared = shared
+        self.segments = []
+
+    def add(self, buffer, fmt, shape, ndarray):
+        padding = -self.size % BUFFER_ALIGNMENT
+        if padding:
+            self.buffers.append(b'\x00' * padding)
+            self.size += padding
+        placeholder = {BUFFER_KEY: [self.size, len(buffer)], 'format': fmt, 'shape': shape, 'ndarray': ndarray}
+        self.buffers.append(buffer)
+        self.size += len(buffer)
+        return placeholder
+
+    def share(self, data, fmt, shape, ndarray):
+        name, nbytes = _write_segment(data, fmt, shape)
+        self.segments.append(name)
+        return {BUFFER_KEY: [0, nbytes], 'shm': name, 'format': fmt, 'shape': shape, 'ndarray': ndarray}
+
+    def pack(self, data):
+        if np is not None and isinstance(data, np.ndarray) and data.dtype.kind in 'iuf':
+            fmt = data.dtype.newbyteorder('<').str
+            if self.shared and data.nbytes >= SHARED_MEMORY_THRESHOLD:
+                return self.share(data, fmt, list(data.shape), True)
+            # unlike ascontiguousarray, require keeps the shape of 0-d arrays
+            a = np.require(data, dtype=fmt, requirements='C')
+            return self.add(a.data.cast('B') if a.size else b'', fmt, list(a.shape), True)
+
+        if isinstance(data, (list, tuple)):
+            shape = _float_shape(data)
+            if shape is not None:
+                count = 1
+                for n in shape:
+                    count *= n
+                if count >= BUFFER_THRESHOLD:
+                    if self.shared and count * 8 >= SHARED_MEMORY_THRESHOLD:
+                        return self.share(data, '<f8', shape, False)
+                    a = array.array('d', _flatten(data, len(shape)))
+                    if sys.byteorder != 'little':
+                        a.byteswap()
+                    return self.add(_tobytes(a), '<f8', shape, False)
+            return [self.pack(item) for item in data]
+
+        if isinstance(data, dict):
+            return dict((key, self.pack(value)) for key, value in data.items())
+
+        return data
+
+
+class _KeyEncoder(DataEncoder):
+    """DataEncoder that leaves out the guids of data objects, which don't describe their content"""
+
+    def default(self, o):
+        data = super(_KeyEncoder, self).default(o)
+        if isinstance(data, dict) and 'guid' in data:
+            data = dict(data)
+            del data['guid']
+        return data
+
+
+def _reshape(flat, shape):
+    if not shape:
+        return flat[0]
+    for n in reversed(shape[1:]):
+        flat = [flat[i:i + n] for i in range(0, len(flat), n)]
+    return flat
+
+
+class _BufferDecoder(DataDecoder):
+    """DataDecoder that restores array placeholders from the binary buffers"""
+
+    def __init__(self, *args, **kwargs):
+        self.payload = kwargs.pop('payload')
+        self.offset = kwargs.pop('offset')
+        super(_BufferDecoder, self).__init__(*args, **kwargs)
+
+    def object_hook(self, o):
+        if BUFFER_KEY in o:
+            return self.restore(o)
+        return super(_BufferDecoder, self).object_hook(o)
+
+    def restore(self, o):
+        if 'shm' in o:
+            return _read_segment(o)
+
+        offset, nbytes = o[BUFFER_KEY]
+        offset += self.offset
+        fmt = o['format']
+
+        if np is not None:
+            dtype = np.dtype(fmt)
+            a = np.frombuffer(self.payload, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset)
+            a = a.reshape(o['shape'])
+            if o['ndarray']:
+                return a
+            return a.tolist()
+
+        a = array.array(TYPECODES[fmt[1:]])
+        chunk = bytes(self.payload[offset:offset + nbytes])
+        if hasattr(a, 'frombytes'):
+            a.frombytes(chunk)
+        else:
+            a.fromstring(chunk)
+        if sys.byteorder != 'little':
+            a.byteswap()
+        return _reshape(a.tolist(), o['shape'])
+
+
+def shared_memory_available():
+    """check if buffers can be exchanged through shared memory in this environment"""
+    return shared_memory is not None and np is not None and os.name == 'posix'
+
+
+def _write_segment(data, fmt, shape):
+    """write an array straight into a new shared memory segment, return its name and size in bytes
+
+    The receiver unlinks the segment once it has read it,
+    the sender keeps the name to release the segment if that never happens.
+    """
+    dtype = np.dtype(fmt)
+    nbytes = dtype.itemsize
+    for n in shape:
+        nbytes *= n
+    segment = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    name = segment.name
+    try:
+        view = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+        view[...] = data
+        del view
+    except Exception:
+        segment.close()
+        segment.unlink()
+        raise
+    segment.close()
+    # the segment outlives this process' interest in it, don't let the resource tracker remove it
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return name, nbytes
+
+
+def release_segments(names):
+    """unlink shared memory segments that were sent but may not have been read, skip those already gone"""
+    for name in names:
+        try:
+            segment = shared_memory.SharedMemory(name=name)
+        except (OSError, ValueError):
+            continue
+        segment.close()
+        segment.unlink()
+
+
+def live_segments(names):
+    """return the names of shared memory segments that still exist"""
+    live = []
+    for name in names:
+        try:
+            segment = shared_memory.SharedMemory(name=name)
+        except (OSError, ValueError):
+            continue
+        segment.close()
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        live.append(name)
+    return live
+
+
+def _read_segment(o):
+    """copy an array out of a shared memory segment, then release the segment"""
+    segment = shared_memory.SharedMemory(name=o['shm'])
+    try:
+        dtype = np.dtype(o['format'])
+        view = np.frombuffer(segment.buf, dtype=dtype, count=o[BUFFER_KEY][1] // dtype.itemsize)
+        a = view.reshape(o['shape']).copy()
+        del view
+    finally:
+        segment.close()
+        segment.unlink()
+    if o['ndarray']:
+        return a
+    return a.tolist()
+
+
+def create_probe():
+    """create a small shared memory segment for a peer to test if it can attach to it"""
+    segment = shared_memory.SharedMemory(create=True, size=1)
+    segment.buf[0] = os.getpid() % 256
+    return segment
+
+
+def check_probe(name, value):
+    """check if a probe segment created by a peer can be attached and holds the expected value"""
+    if not shared_memory_available():
+        return False
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except (OSError, ValueError):
+        return False
+    found = segment.buf[0]
+    segment.close()
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return found == value
+
+
+def dumps_binary(data, shared=False, segments=None):
+    """encode data into a binary message: a json header followed by raw little-endian array buffers
+
+    The message starts with the length of the header as an unsigned 32-bit integer.
+    Numpy arrays and (nested) lists of floats are replaced in the header by placeholders
+    pointing into the buffer section, everything else is encoded with ``DataEncoder``.
+    With ``shared=True`` large buffers are placed in shared memory segments instead,
+    and only their names are sent. The names of the new segments are added to ``segments``,
+    so the sender can release them with ``release_segments`` if the receiver never reads them.
+    """
+    packer = _Packer(shared)
+    try:
+        header = json.dumps(packer.pack(data), cls=DataEncoder).encode('utf-8')
+    except Exception:
+        release_segments(packer.segments)
+        raise
+    if segments is not None:
+        segments.extend(packer.segments)
+    padding = -(4 + len(header)) % BUFFER_ALIGNMENT
+    header += b' ' * padding
+    return b''.join(chain([struct.pack('<I', len(header)), header], packer.buffers))
+
+
+def loads_binary(payload):
+    """decode a binary message created by ``dumps_binary``
+
+    Numpy arrays are rebuilt as read-only views on the received payload without copying.
+    """
+    size, = struct.unpack('<I', payload[:4])
+    header = bytes(payload[4:4 + size]).decode('utf-8')
+    return json.loads(header, cls=_BufferDecoder, payload=payload, offset=4 + size)
+
+
+def loads_header(payload):
+    """decode only the json header of a binary message, leaving placeholders and data objects as they are"""
+    size, = struct.unpack('<I', payload[:4])
+    return json.loads(bytes(payload[4:4 + size]).decode('utf-8'))
+
+
+def content_key(data):
+    """return a key that identifies data by a hash of its content
+
+    The hash covers the same json header and raw array buffers as ``dumps_binary``,
+    with sorted dictionary keys, so equal data gives the same key on every client.
+    """
+    packer = _Packer()
+    header = json.dumps(packer.pack(data), cls=_KeyEncoder, sort_keys=True)
+    h = hash_function(header.encode('utf-8'))
+    for buffer in packer.buffers:
+        h.update(buffer)
+    return h.hexdigest()[:32]
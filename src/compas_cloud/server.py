@@ -1,3 +1,9 @@
+try:
+    import asyncio
+except ImportError:
+    # Trollius >= 0.3 was renamed
+    import trollius as asyncio
+
 from autobahn.asyncio.websocket import WebSocketServerProtocol
 
 import compas
@@ -6,95 +12,462 @@ from compas.utilities import DataDecoder
 import importlib
 import json
 from compas_cloud import Sessions
+from compas_cloud.cache import Cache
+from compas_cloud.cache import Memo
+from compas_cloud.cache import Namespaces
+from compas_cloud.cache import SHARED
+from compas_cloud.cache import readonly
+from compas_cloud.metrics import Metrics
+from compas_cloud.metrics import serve_metrics
+from compas_cloud.tracing import request_name
+from compas_cloud.serialization import dumps_binary
+from compas_cloud.serialization import loads_binary
+from compas_cloud.serialization import loads_header
+from compas_cloud.serialization import content_key
+from compas_cloud.serialization import check_probe
+from compas_cloud.serialization import release_segments
+from compas_cloud.serialization import live_segments
+from collections.abc import Iterator
 from threading import Thread
+from threading import current_thread
+from threading import Lock
 from multiprocessing import Queue
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import functools
+import inspect
+import os
+import shutil
+import signal
+import socket
+import tempfile
 import time
 import sys
 import traceback
 import pkg_resources
+import uuid
 
 
 class CompasServerProtocol(WebSocketServerProtocol):
     """The CompasServerProtocol defines the behaviour of compas cloud server"""
-    cached = {}
+    cached = Cache()
+    memo = Memo(cached)
+    namespaces = Namespaces(cached)
+    metrics = Metrics()
+    # seconds before the objects of a closed connection or session are released, negative to keep them
+    session_grace = 60
+    releases = {}
     sessions = None
+    shared_memory = False
+    # shared memory segments sent to a connection are checked for having been read from this many on
+    segments_check = 256
+    chunk_bytes = 2**20
+    chunk_items = 10000
+    # smaller messages are sent uncompressed when the client negotiated compression
+    compress_threshold = 1024
+    executor = None
+    process_pool = None
+    functions = {}
+    iterators = {}
+    # end positions of recently exhausted iterators, for requests that were sent before the end was known
+    finished = {}
+    finished_size = 1000
 
     def onConnect(self, request):
         """print client info on connection"""
         print("Client connecting: {}".format(request.peer))
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = current_thread()
+        self.segments = []
+        self.segments_lock = Lock()
+        self.closed = False
+        self.join(uuid.uuid4().hex)
 
     def onClose(self, wasClean, code, reason):
-        """print reason on connection closes"""
+        """print reason on connection closes, release the objects of the connection after the grace period"""
         print("WebSocket connection closed: {}".format(reason))
+        if getattr(self, 'segments_lock', None) is not None:
+            with self.segments_lock:
+                self.closed = True
+                segments, self.segments = self.segments, []
+            release_segments(segments)
+        if getattr(self, 'namespace', None) is not None:
+            self.leave(self.namespace)
+
+    def join(self, namespace):
+        """use a namespace for the objects cached through this connection, cancelling a pending release of it"""
+        handle = self.releases.pop(namespace, None)
+        if handle is not None:
+            self.loop.call_soon_threadsafe(handle.cancel)
+        self.namespaces.open(namespace)
+        self.namespace = namespace
+
+    def leave(self, namespace):
+        """stop using a namespace, its objects are released after the grace period unless it is joined again"""
+        if self.namespaces.close(namespace) > 0 or self.session_grace < 0:
+            return
+
+        def schedule():
+            self.releases[namespace] = self.loop.call_later(self.session_grace, self.release_namespace, namespace)
+
+        self.loop.call_soon_threadsafe(schedule)
+
+    def release_namespace(self, namespace):
+        """release the cached objects and remote iterators of a namespace no connection uses anymore"""
+        self.releases.pop(namespace, None)
+        released = self.namespaces.release(namespace)
+        for _id, state in list(self.iterators.items()):
+            if state['namespace'] == namespace:
+                self.close_iterator({'close_iterator': _id})
+        if released:
+            print("released {} cached objects of {}".format(len(released), namespace))
+
+    def check_visible(self, _id):
+        """raise a KeyError if a cached object is not visible from the namespace of this connection"""
+        if not self.namespaces.visible(self.namespace, _id):
+            raise KeyError("There is no cached object {} on the server.".format(_id))
+
+    def fetch(self, _id):
+        """return a cached object, if it is visible from the namespace of this connection"""
+        self.check_visible(_id)
+        return self.cached[_id]
 
     def onMessage(self, payload, isBinary):
         """process the income messages"""
-        result = self.process(payload)
-        self.sendMessage(result.encode(), isBinary)
-
-    def callback(self, _id, *args, **kwargs):
-        """send the arguments of callback functions to client side"""
+        if self.executor is None:
+            result = self.process(payload, isBinary)
+            self.sendMessage(result, isBinary)
+        else:
+            future = self.loop.run_in_executor(self.executor, self.process, payload, isBinary)
+            future.add_done_callback(lambda f: self.sendMessage(f.result(), isBinary))
+
+    def sendMessage(self, payload, isBinary=False, *args, **kwargs):
+        """send a message, handing it over to the event loop when called from an executor thread"""
+        send = super(CompasServerProtocol, self).sendMessage
+        kwargs.setdefault('doNotCompress', len(payload) < self.compress_threshold)
+        if current_thread() is not self.loop_thread:
+            self.loop.call_soon_threadsafe(functools.partial(send, payload, isBinary, *args, **kwargs))
+        else:
+            send(payload, isBinary, *args, **kwargs)
+
+    def encode(self, data, isBinary=False):
+        """encode data into a message payload in the same mode the client uses"""
+        if isBinary:
+            if not self.shared_memory:
+                return dumps_binary(data)
+            segments = []
+            payload = dumps_binary(data, True, segments)
+            self.track_segments(segments)
+            return payload
+        return json.dumps(data, cls=DataEncoder).encode()
+
+    def track_segments(self, segments):
+        """remember the shared memory segments sent to the client, to unlink those it never reads on close"""
+        if not segments:
+            return
+        with self.segments_lock:
+            if not self.closed:
+                self.segments.extend(segments)
+                if len(self.segments) >= self.segments_check:
+                    # the client unlinks the segments it reads, only the others need to be kept
+                    self.segments = live_segments(self.segments)
+                return
+        release_segments(segments)
+
+    def decode(self, payload, isBinary=False):
+        """decode a received message payload"""
+        if isBinary:
+            return loads_binary(payload)
+        return json.loads(payload, cls=DataDecoder)
+
+    def request_id(self, payload, isBinary=False):
+        """find the request id of a payload that can't be decoded, reading it as plain json"""
+        try:
+            data = loads_header(payload) if isBinary else json.loads(payload)
+        except Exception:
+            return None
+        if isinstance(data, dict):
+            return data.get('request_id')
+        return None
+
+    def callback(self, _id, binary, *args, **kwargs):
+        """send the arguments of callback functions to client side, in the mode of the request using them"""
         data = {'callback': {'id': _id, 'args': args, 'kwargs': kwargs}}
-        istring = json.dumps(data, cls=DataEncoder)
-        self.sendMessage(istring.encode())
+        self.sendMessage(self.encode(data, binary), binary)
+
+    def error(self):
+        """return the response to a request that failed with the exception being handled"""
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        return {'error': traceback.format_exception(exc_type, exc_value, exc_tb)}
 
-    def load_cached(self, data):
-        """detect and load cached data or callback functions in arguments"""
+    def load_cached(self, data, binary=False):
+        """detect and load cached data or callback functions in arguments
+
+        Cached objects are passed as read-only arrays or copies, a function changing its arguments
+        in place would otherwise change the object behind a reference that is a hash of its content.
+        """
         for i, a in enumerate(data['args']):
             if isinstance(a, dict):
                 if 'cached' in a:
-                    data['args'][i] = self.cached[a['cached']]
+                    data['args'][i] = readonly(self.fetch(a['cached']))
 
         for key in data['kwargs']:
             if isinstance(data['kwargs'][key], dict):
                 if 'cached' in data['kwargs'][key]:
-                    data['kwargs'][key] = self.cached[data['kwargs'][key]['cached']]
+                    data['kwargs'][key] = readonly(self.fetch(data['kwargs'][key]['cached']))
                 if 'callback' in data['kwargs'][key]:
                     _id = data['kwargs'][key]['callback']['id']
-                    self.cached[_id] = lambda *args, **kwargs: self.callback(
-                        _id, *args, **kwargs)
+                    self.cached.set(_id, lambda *args, **kwargs: self.callback(
+                        _id, binary, *args, **kwargs), pin=True)
+                    self.namespaces.add(self.namespace, _id)
                     data['kwargs'][key] = self.cached[_id]
 
-    def execute(self, data):
+    def resolve(self, package):
+        """return the function of given dotted path, it is imported and registered on first use"""
+        function = self.functions.get(package)
+        if function is None:
+            names = package.split('.')
+            name = '.'.join(names[:-1])
+            module = importlib.import_module(name)
+            function = getattr(module, names[-1])
+            self.functions[package] = function
+        return function
+
+    @classmethod
+    def preload(cls, modules):
+        """import given modules and register all their public callables, returns the registered paths"""
+        paths = []
+        for name in modules:
+            module = importlib.import_module(name)
+            for attr in dir(module):
+                if attr.startswith('_'):
+                    continue
+                function = getattr(module, attr)
+                if callable(function):
+                    path = '{}.{}'.format(name, attr)
+                    cls.functions[path] = function
+                    paths.append(path)
+        return paths
+
+    def execute(self, data, binary=False):
         """execute corresponding binded functions with received arguments"""
         package = data['package']
-        names = package.split('.')
-        name = '.'.join(names[:-1])
-        module = importlib.import_module(name)
-        function = getattr(module, names[-1])
+        function = self.resolve(package)
 
         start = time.time()
         print('running:', package)
-        self.load_cached(data)
+        result = self.invoke(function, data, binary)
+        if data.get('stream') and not data['cache']:
+            result = self.stream(result, data)
+        elif isinstance(result, Iterator):
+            # generators, map, zip, itertools and the like are pulled item by item instead of encoded whole
+            result = self.register_iterator(result)
+        t = time.time()-start
+        print('finished in: {}s'.format(t))
+        return result
+
+    def invoke(self, function, data, binary=False):
+        """call a function with the arguments of a request, cache or memoize the result if requested"""
+        if data.get('memoize') and not inspect.isgeneratorfunction(function):
+            key = self.memo_key(data)
+            if key is not None:
+                # a memoized result must not reveal what was computed from objects of other clients
+                for a in list(data['args']) + list(data['kwargs'].values()):
+                    if isinstance(a, dict) and 'cached' in a:
+                        self.check_visible(a['cached'])
+                found, result = self.memo.lookup(key)
+                if found and not (data['cache'] and result['cached'] not in self.cached):
+                    if data['cache']:
+                        self.namespaces.add(self.namespace, result['cached'])
+                    return result
+                result = self.invoke(function, dict(data, memoize=False), binary)
+                if not isinstance(result, Iterator):
+                    # an iterator is used up by the first call that pulls from it
+                    self.memo.store(key, result)
+                return result
+
+        self.load_cached(data, binary)
 
         if data['cache']:
-            to_cache = function(*data['args'], **data['kwargs'])
-            self.cached[id(to_cache)] = to_cache
-            result = {'cached': id(to_cache)}
+            to_cache = self.call(function, data['args'], data['kwargs'])
+            _id = self.key(to_cache)
+            self.cached[_id] = to_cache
+            self.namespaces.add(self.namespace, _id)
+            result = {'cached': _id}
+        else:
+            result = self.call(function, data['args'], data['kwargs'])
+        return result
+
+    def stream(self, result, data):
+        """keep the chunks of a result on the server as a remote iterator, the client pulls them one by one
+
+        Arrays and lists are sliced along their first axis, iterators are sent item by item
+        as they are produced, any other result is sent as a single chunk.
+        """
+        size = data.get('chunk_size')
+
+        if hasattr(result, 'shape') and len(result.shape) > 0:
+            if not size:
+                row = result[0].nbytes if len(result) else 1
+                size = max(1, self.chunk_bytes // max(row, 1))
+            chunks = (result[i:i + size] for i in range(0, len(result), size))
+        elif isinstance(result, (list, tuple)):
+            size = size or self.chunk_items
+            chunks = (result[i:i + size] for i in range(0, len(result), size))
+        elif isinstance(result, Iterator):
+            chunks = result
         else:
-            result = function(*data['args'], **data['kwargs'])
+            chunks = iter([result])
+
+        return self.register_iterator(chunks)
+
+    def register_iterator(self, generator):
+        """keep a generator alive on the server and return a handle to pull its items"""
+        _id = uuid.uuid4().hex
+        self.iterators[_id] = {'generator': generator, 'position': 0, 'lock': Lock(), 'namespace': self.namespace}
+        return {'iterator': _id}
+
+    def next_items(self, data):
+        """pull up to count items from a remote iterator, with the position of the first one
+
+        The iterator is forgotten once it is exhausted or raises an error.
+        """
+        _id = data['next']
+        if _id in self.finished:
+            return {'items': [], 'start': self.finished[_id], 'done': True}
+        if _id not in self.iterators:
+            raise KeyError("There is no iterator {} on the server.".format(_id))
+        state = self.iterators[_id]
+        with state['lock']:
+            start = state['position']
+            items = []
+            try:
+                while state['generator'] is not None and len(items) < data.get('count', 1):
+                    try:
+                        items.append(next(state['generator']))
+                    except StopIteration:
+                        state['generator'] = None
+            except BaseException:
+                state['generator'] = None
+                self.iterators.pop(_id, None)
+                raise
+            state['position'] += len(items)
+            if state['generator'] is None and self.iterators.pop(_id, None) is not None:
+                self.finished[_id] = state['position']
+                while len(self.finished) > self.finished_size:
+                    del self.finished[next(iter(self.finished))]
+            return {'items': items, 'start': start, 'done': state['generator'] is None}
+
+    def close_iterator(self, data):
+        """stop a remote iterator and forget it"""
+        self.finished.pop(data['close_iterator'], None)
+        state = self.iterators.pop(data['close_iterator'], None)
+        if state is not None:
+            with state['lock']:
+                if state['generator'] is not None:
+                    state['generator'].close()
+        return {'closed': data['close_iterator']}
+
+    def memo_key(self, data):
+        """key of a call for memoization: a hash of the function path, options and undecoded arguments
+
+        Cached arguments are hashed by their reference, which is itself a content hash, or a unique id
+        for content that can't be hashed. This holds because functions only get read-only arrays or copies
+        of cached objects, see ``load_cached``, so the content behind a reference never changes.
+        Calls with callbacks are not memoized.
+        """
+        for a in list(data['args']) + list(data['kwargs'].values()):
+            if isinstance(a, dict) and 'callback' in a:
+                return None
+        try:
+            return 'memo-' + content_key([data['package'], data['cache'], data['args'], data['kwargs']])
+        except (TypeError, ValueError):
+            return None
+
+    def batch(self, data, binary=False):
+        """execute a list of function calls in one pass, errors are returned per call"""
+        calls = data['batch']
+        results = []
+
+        start = time.time()
+        print('running batch of {} calls'.format(len(calls)))
+        for call in calls:
+            try:
+                function = self.resolve(call['package'])
+                results.append(self.invoke(function, call, binary))
+            except Exception:
+                results.append(self.error())
         t = time.time()-start
         print('finished in: {}s'.format(t))
-        return result
+        return results
+
+    def call(self, function, args, kwargs):
+        """call a function, in the process pool if there is one and no callbacks or generators are involved"""
+        if self.process_pool is not None and not inspect.isgeneratorfunction(function):
+            if not any(callable(a) for a in list(args) + list(kwargs.values())):
+                return self.process_pool.submit(function, *args, **kwargs).result()
+        return function(*args, **kwargs)
 
     def get(self, data):
         """get cached data from its id"""
         _id = data['get']
-        return self.cached[_id]
+        return self.fetch(_id)
+
+    def key(self, obj):
+        """return the content hash of an object, or a unique id if it can not be hashed"""
+        try:
+            return content_key(obj)
+        except (TypeError, ValueError):
+            return uuid.uuid4().hex
+
+    def scope(self, data):
+        """return the namespace an object should be cached in, the shared one or the one of this connection"""
+        scope = data.get('scope')
+        if scope is None:
+            return self.namespace
+        if scope != SHARED:
+            raise ValueError("Unknown cache scope {}, use '{}' or None.".format(scope, SHARED))
+        return SHARED
 
     def cache(self, data):
         """cache received data and return its reference object"""
         to_cache = data['cache']
-        _id = id(to_cache)
-        self.cached[_id] = to_cache
+        _id = data.get('key') or self.key(to_cache)
+        self.cached.set(_id, to_cache, pin=data.get('pin', False))
+        self.namespaces.add(self.scope(data), _id)
         return {'cached': _id}
 
+    def cache_key(self, data):
+        """check if an object of given content key is cached already, so its upload can be skipped"""
+        _id = data['cache_key']
+        if _id not in self.cached:
+            return {'missing': _id}
+        if data.get('pin'):
+            self.cached.pin(_id)
+        self.namespaces.add(self.scope(data), _id)
+        return {'cached': _id}
+
+    def release(self, data):
+        """remove a cached object from the namespace of this connection, and from the server if no other holds it"""
+        _id = data['release']
+        if not self.namespaces.visible(self.namespace, _id):
+            raise KeyError("There is no cached object {} on the server.".format(_id))
+        if self.namespaces.remove(self.namespace, _id):
+            self.cached.release(_id)
+        return {'released': _id}
+
     def cache_func(self, data):
-        """cache a excutable function"""
+        """cache a excutable function under a hash of its source, functions of other clients may share its name"""
         name = data['cache_func']['name']
-        exec(data['cache_func']['source'])
-        exec('self.cached[name] = {}'.format(name))
-        return {'cached_func': name}
+        source = data['cache_func']['source']
+        _id = 'func-' + content_key([name, source])
+        namespace = dict(globals())
+        exec(source, namespace)
+        self.cached[_id] = namespace[name]
+        self.cached.pin(_id)
+        self.namespaces.add(self.namespace, _id)
+        return {'cached_func': _id}
 
     def sessions_alive(self):
         return isinstance(self.sessions, Sessions)
@@ -106,7 +479,25 @@ class CompasServerProtocol(WebSocketServerProtocol):
         if command == 'check':
             print('check from client')
             return {'status': "I'm good"}
-            
+        if command == 'registry':
+            return sorted(self.functions)
+        if command == 'shared_memory':
+            self.shared_memory = check_probe(data['probe'], data['value'])
+            return self.shared_memory
+        if command == 'memo':
+            return self.memo.stats()
+        if command == 'stats':
+            return self.metrics.stats(self.cached, self.memo)
+        if command == 'session':
+            previous = self.namespace
+            self.join('session-{}'.format(data['name']))
+            self.leave(previous)
+            return {'session': data['name']}
+        if command == 'preload':
+            paths = self.preload(data['modules'])
+            print('preloaded {} functions from: {}'.format(len(paths), ', '.join(data['modules'])))
+            return {'preloaded': len(paths)}
+
         raise ValueError("Unrecognised control command")
 
     def control_sessions(self, data):
@@ -114,7 +505,7 @@ class CompasServerProtocol(WebSocketServerProtocol):
         s = data["sessions"]
         if s["command"] == 'create':
             if not self.sessions_alive():
-                self.sessions = Sessions(socket=self)
+                self.sessions = Sessions(*s['args'], socket=self, **s['kwargs'])
                 return "session successfully created"
             else:
                 raise RuntimeError("There is already sessions running, try to reconnect or shut down")
@@ -124,9 +515,9 @@ class CompasServerProtocol(WebSocketServerProtocol):
 
             if s["command"] == 'add_task':
                 func_id = s['func']['cached_func']
-                func = self.cached[func_id]
-                self.sessions.add_task(func, *s['args'], *s['kwargs'])
-                return "task added"
+                func = self.fetch(func_id)
+                task_id = self.sessions.add_task(func, *s['args'], **s['kwargs'])
+                return "task-{} added".format(task_id)
 
             if s["command"] == 'start':
                 self.sessions.start()
@@ -134,31 +525,86 @@ class CompasServerProtocol(WebSocketServerProtocol):
 
             if s["command"] == 'listen':
                 self.sessions.listen()
-                self.sessions = None
-                return "All sessions concluded"
+                self.sessions.shutdown()
+                sessions, self.sessions = self.sessions, None
+                return {"results": sessions.results, "errors": sessions.errors}
 
             if s["command"] == 'shutdown':
                 self.sessions.terminate()
                 self.sessions = None
 
-    def process(self, data):
-        """process received data according to its content"""
-        data = json.loads(data, cls=DataDecoder)
+    def process(self, payload, isBinary=False):
+        """process received data according to its content, recording the time spent and the sizes
 
+        Requests that can't be decoded and results that can't be encoded are answered with an error,
+        tagged with the request id if it can still be read, so that the client fails the right call.
+        """
+        self.metrics.begin()
+        try:
+            start = time.time()
+            try:
+                data = self.decode(payload, isBinary)
+                decoded = time.time()
+                result = self.handle(data, isBinary)
+            except Exception:
+                # the request could not be decoded or is not a request at all, handle reports other errors
+                data = {'undecodable': True}
+                decoded = time.time()
+                result = self.error()
+                print("".join(result['error']))
+                _id = self.request_id(payload, isBinary)
+                if _id is not None:
+                    data['request_id'] = _id
+                    result = {'request_id': _id, 'result': result}
+            handled = time.time()
+            try:
+                message = self.encode(result, isBinary)
+            except Exception:
+                result = self.error()
+                print("".join(result['error']))
+                if 'request_id' in data:
+                    result = {'request_id': data['request_id'], 'result': result}
+                message = self.encode(result, isBinary)
+            timings = (decoded - start, handled - decoded, time.time() - handled)
+            if isinstance(result, dict) and 'request_id' in data:
+                result = result['result']
+            error = isinstance(result, dict) and 'error' in result
+            self.metrics.record(request_name(data), timings, len(payload), len(message), error)
+        finally:
+            self.metrics.end()
+        return message
+
+    def handle(self, data, binary=False):
+        """handle a decoded request according to its content, binary tells the mode of the request"""
         try:
 
-            if 'cache' in data:
+            if 'cache' in data and 'package' not in data:
                 result = self.cache(data)
 
+            if 'cache_key' in data:
+                result = self.cache_key(data)
+
             if 'cache_func' in data:
                 result = self.cache_func(data)
 
             if 'package' in data:
-                result = self.execute(data)
+                result = self.execute(data, binary)
+
+            if 'batch' in data:
+                result = self.batch(data, binary)
+
+            if 'next' in data:
+                result = self.next_items(data)
+
+            if 'close_iterator' in data:
+                result = self.close_iterator(data)
 
             if 'get' in data:
                 result = self.get(data)
 
+            if 'release' in data:
+                result = self.release(data)
+
             if 'sessions' in data:
                 result = self.control_sessions(data)
 
@@ -172,13 +618,14 @@ class CompasServerProtocol(WebSocketServerProtocol):
 
             if isinstance(error, KeyboardInterrupt):
                 raise KeyboardInterrupt
-            
-            exc_type, exc_value, exc_tb = sys.exc_info()
-            result = {'error': traceback.format_exception(exc_type, exc_value, exc_tb)}
+
+            result = self.error()
             print("".join(result['error']))
 
-        istring = json.dumps(result, cls=DataEncoder)
-        return istring
+        if 'request_id' in data:
+            result = {'request_id': data['request_id'], 'result': result}
+
+        return result
 
     def version(self):
 
@@ -193,26 +640,46 @@ class CompasServerProtocol(WebSocketServerProtocol):
         }
 
 
-if __name__ == '__main__':
+def accept_compression(offers):
+    """accept a permessage-deflate offer of a client, if it makes one"""
+    from autobahn.websocket.compress import PerMessageDeflateOffer
+    from autobahn.websocket.compress import PerMessageDeflateOfferAccept
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+    return None
 
-    try:
-        import asyncio
-    except ImportError:
-        # Trollius >= 0.3 was renamed
-        import trollius as asyncio
+
+def serve(options, reuse_port=False):
+    """run a server on the event loop of this process until it is shut down"""
+    if options.executor != 'none':
+        CompasServerProtocol.executor = ThreadPoolExecutor(options.pool_size)
+    if options.executor == 'process':
+        CompasServerProtocol.process_pool = ProcessPoolExecutor(options.pool_size)
 
     from autobahn.asyncio.websocket import WebSocketServerFactory
     factory = WebSocketServerFactory()
     factory.protocol = CompasServerProtocol
+    factory.setProtocolOptions(perMessageCompressionAccept=accept_compression)
+
+    ip = options.host
+    port = options.port
 
-    ip = '127.0.0.1'
-    port = 9000
+    if options.metrics_port is not None:
+        protocol = CompasServerProtocol
+        serve_metrics(options.metrics_port, lambda: protocol.metrics.prometheus(protocol.cached, protocol.memo), ip)
+        print("serving metrics at http://%s:%s" % (ip, options.metrics_port))
 
     loop = asyncio.get_event_loop()
-    coro = loop.create_server(factory, '127.0.0.1', 9000)
+    if reuse_port:
+        coro = loop.create_server(factory, ip, port, reuse_port=True)
+    else:
+        coro = loop.create_server(factory, ip, port)
     server = loop.run_until_complete(coro)
     print("starting compas_cloud server")
     print("Listenning at %s:%s" % (ip, port))
+    if options.executor != 'none':
+        print("executing functions in {} pool".format(options.executor))
 
     try:
         loop.run_forever()
@@ -222,3 +689,116 @@ if __name__ == '__main__':
         print("shuting down server")
         server.close()
         loop.close()
+        if CompasServerProtocol.cached.directory:
+            CompasServerProtocol.cached.flush()
+        if CompasServerProtocol.executor is not None:
+            CompasServerProtocol.executor.shutdown(wait=False)
+        if CompasServerProtocol.process_pool is not None:
+            CompasServerProtocol.process_pool.shutdown(wait=False)
+
+
+def run_workers(options):
+    """fork server processes listening at the same port, the group stops as soon as one of them stops
+
+    The workers share their cache through the disk tier, every cached object is written to it,
+    so a reference created on one worker can be used on all others.
+    """
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("Running several workers needs a system with fork and SO_REUSEPORT.")
+
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+
+    # inherited by the workers, so terminating the group shuts every server down cleanly
+    signal.signal(signal.SIGTERM, interrupt)
+
+    workers = []
+    for index in range(options.workers):
+        pid = os.fork()
+        if pid == 0:
+            # each worker has metrics of its own, served at consecutive ports
+            if options.metrics_port is not None:
+                options.metrics_port += index
+            try:
+                serve(options, reuse_port=True)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        workers.append(pid)
+    print("started {} workers: {}".format(len(workers), ', '.join(str(pid) for pid in workers)))
+
+    try:
+        os.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='start a compas_cloud server')
+    parser.add_argument('port', type=int, nargs='?', default=9000, help='port to listen at')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen at, 0.0.0.0 to accept connections from other machines')
+    parser.add_argument('--executor', choices=['none', 'thread', 'process'], default='none',
+                        help='run functions in a thread or process pool instead of on the event loop')
+    parser.add_argument('--pool-size', type=int, default=None, help='number of executor workers')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of server processes sharing the port, each with its own event loop')
+    parser.add_argument('--cache-size', type=float, default=None, metavar='MB',
+                        help='memory budget of the object cache, least recently used objects are evicted beyond it')
+    parser.add_argument('--cache-dir', default=None,
+                        help='folder for the disk tier of the object cache, evicted objects are spilled to it')
+    parser.add_argument('--cache-disk-size', type=float, default=4096, metavar='MB',
+                        help='budget of the disk tier, least recently used files are deleted beyond it')
+    parser.add_argument('--memo-size', type=int, default=128,
+                        help='maximum number of memoized function results')
+    parser.add_argument('--session-grace', type=float, default=60, metavar='SECONDS',
+                        help='delay before the cached objects of a closed connection or session are released, '
+                             'negative to keep them')
+    parser.add_argument('--compress-threshold', type=int, default=1024, metavar='BYTES',
+                        help='messages from this size on are compressed for clients that negotiated compression')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='port of an http endpoint serving metrics in the Prometheus text format')
+    parser.add_argument('--preload', nargs='*', default=[], metavar='MODULE',
+                        help='modules to import and register at startup')
+    options = parser.parse_args()
+
+    CompasServerProtocol.compress_threshold = options.compress_threshold
+    CompasServerProtocol.session_grace = options.session_grace
+
+    # workers share the cache through its disk tier, in a temporary folder if none is given
+    temp_dir = None
+    if options.workers > 1 and options.cache_dir is None:
+        temp_dir = options.cache_dir = tempfile.mkdtemp(prefix='compas_cloud-')
+
+    if options.cache_size is not None or options.cache_dir is not None:
+        max_bytes = int(options.cache_size * 2**20) if options.cache_size is not None else None
+        CompasServerProtocol.cached = Cache(max_bytes, options.cache_dir, write_through=options.workers > 1,
+                                            max_disk_bytes=int(options.cache_disk_size * 2**20))
+    CompasServerProtocol.memo = Memo(CompasServerProtocol.cached, options.memo_size)
+    CompasServerProtocol.namespaces = Namespaces(CompasServerProtocol.cached)
+
+    if options.preload:
+        paths = CompasServerProtocol.preload(options.preload)
+        print("preloaded {} functions from: {}".format(len(paths), ', '.join(options.preload)))
+
+    try:
+        if options.workers > 1:
+            run_workers(options)
+        else:
+            serve(options)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
@@ -6,47 +6,225 @@ import time
 import os
 import sys
 import json
+import atexit
+import marshal
+import tempfile
+import types
+from collections import deque
 from multiprocessing import Process, Queue, cpu_count
 from contextlib import contextmanager
 import traceback
+from array import array
+from threading import Condition
+from threading import Lock
 from threading import Thread
 
 try:
-    from StringIO import StringIO
+    import cPickle as pickle
 except ImportError:
-    from io import StringIO
+    import pickle
 
-class CapturedText(object):
-    log_path = None
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .serialization import dumps_binary
+from .serialization import loads_binary
+from .serialization import shared_memory_available
+
+
+# encoded results from this size on are passed to the session through a file instead of the queue
+RESULT_SPILL_THRESHOLD = 2**20
+# with chunksize 'auto', chunks are sized to take about this many seconds, and hold at most MAX_CHUNKSIZE tasks
+AUTO_CHUNK_SECONDS = 0.2
+MAX_CHUNKSIZE = 1000
+# how often a listening session sends tasks that are waiting for their chunk to fill up
+DISPATCH_INTERVAL = 0.1
+
+
+class TaskOutput(object):
+    """A file-like object that forwards the output of the tasks of a worker to the session in batches of lines.
+
+    Parameters
+    ----------
+    messages : :class:`multiprocessing.Queue`
+        The queue of messages to the session.
+    interval : float, optional
+        The minimum time in seconds between two batches of lines.
+        Default is ``0.1``.
+    max_lines : int, optional
+        The maximum number of lines held for the next batch, further lines are skipped and counted.
+        Default is ``1000``.
+
+    Notes
+    -----
+    Lines are forwarded as soon as they are complete, unless a batch was sent less than ``interval``
+    seconds ago, in which case they are held and sent together with the lines written in between.
+    A background thread sends held lines when the interval is over, so the output of a task arrives
+    while it runs but a chatty task cannot flood the session with messages.
+
+    """
+
+    def __init__(self, messages, interval=0.1, max_lines=1000):
+        self.messages = messages
+        self.interval = interval
+        self.max_lines = max_lines
+        self.task_id = None
+        self.partial = ""
+        self.lines = []
+        self.skipped = 0
+        self.last = 0
+        self.lock = Condition()
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def begin(self, task_id):
+        """attribute the following output to a task"""
+        with self.lock:
+            self.task_id = task_id
+
+    def write(self, text):
+        with self.lock:
+            lines = (self.partial + text).split("\n")
+            self.partial = lines.pop()
+            if not lines:
+                return
+            room = self.max_lines - len(self.lines)
+            self.lines.extend(line + "\n" for line in lines[:room])
+            self.skipped += max(0, len(lines) - room)
+            self.lock.notify()
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        """send the remaining output of the current task, including an unfinished last line"""
+        with self.lock:
+            if self.partial:
+                self.lines.append(self.partial + "\n")
+                self.partial = ""
+            if self.lines or self.skipped:
+                self.send()
+
+    def send(self):
+        prefix = "task-{} log: ".format(self.task_id)
+        text = "".join(prefix + line for line in self.lines)
+        if self.skipped:
+            text += "{}... {} lines skipped\n".format(prefix, self.skipped)
+        self.messages.put(("task_log", text))
+        self.lines = []
+        self.skipped = 0
+        self.last = time.time()
+
+    def run(self):
+        with self.lock:
+            while True:
+                if not self.lines and not self.skipped:
+                    self.lock.wait()
+                    continue
+                delay = self.last + self.interval - time.time()
+                if delay > 0:
+                    self.lock.wait(delay)
+                    continue
+                self.send()
 
 
 @contextmanager
-def captured(name=None, log_path=None):
+def captured(output=None, log_path=None):
+    """redirect stdout and stderr to a log file or to the output of a worker"""
 
     stdout = sys.stdout
     stderr = sys.stderr
 
-
     if log_path:
         sys.stdout = sys.stderr = open(log_path, "w", 1)
     else:
-        sys.stdout = sys.stderr = StringIO()
-    c = CapturedText()
-    c.name = name
-    c.outfile = sys.stdout
-    c.log_path = log_path
+        sys.stdout = sys.stderr = output
 
-    yield c
+    try:
+        yield
+    finally:
+        if log_path:
+            sys.stdout.close()
+        else:
+            output.finish()
+        sys.stdout = stdout
+        sys.stderr = stderr
+
+
+def pack_function(func):
+    """pickle a function by reference, together with its code for workers that can't find it by reference"""
+    try:
+        data = pickle.dumps(func, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        data = None
+    code = None
+    if hasattr(func, "__code__") and not func.__closure__:
+        code = marshal.dumps(func.__code__)
+    if data is None and code is None:
+        raise ValueError("Task function {} can be neither pickled nor rebuilt from its code".format(func))
+    return data, code, getattr(func, "__name__", None), getattr(func, "__defaults__", None), func.__module__
+
+
+def unpack_function(packed):
+    """rebuild a function packed by pack_function, in the globals of its module if the worker has it"""
+    data, code, name, defaults, module = packed
+    if data is not None:
+        try:
+            return pickle.loads(data)
+        except AttributeError:
+            # defined in the main module after the workers were started
+            if code is None:
+                raise
+    module = sys.modules.get(module)
+    namespace = vars(module) if module is not None else {"__builtins__": __builtins__}
+    return types.FunctionType(marshal.loads(code), namespace, name, defaults)
+
+
+def pack_result(result, shared=False, directory=None):
+    """encode the return value of a task, with large arrays in shared memory and large results in a spill file"""
+    if shared and np is not None and isinstance(result, np.ndarray) and result.dtype.kind in "iuf":
+        kind, data = "binary", dumps_binary(result, shared)
+    else:
+        # pickle keeps the exact types, like tuples and integer dictionary keys, that json would change
+        kind, data = "pickle", pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    if len(data) < RESULT_SPILL_THRESHOLD:
+        return kind, data, None
+    handle, path = tempfile.mkstemp(prefix="compas_cloud-result-", dir=directory)
+    with os.fdopen(handle, "wb") as f:
+        f.write(data)
+    return kind, None, path
 
-    if log_path:
-        c.outfile.close()
 
-    sys.stdout = stdout
-    sys.stderr = stderr
+def unpack_result(packed):
+    """decode a result packed by pack_result, removing its spill file"""
+    kind, data, path = packed
+    if path is not None:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.remove(path)
+    if kind == "binary":
+        return loads_binary(data)
+    return pickle.loads(data)
 
 
+# task statuses, a task's position in this tuple is its code in Sessions.status_codes
+STATUSES = ("waiting", "running", "failed", "finished")
+STATUS_CODES = dict((status, code) for code, status in enumerate(STATUSES))
 
-TASK_FINISHED = "____FINISHED____"
+
+def describe(task_ids):
+    """name a task, or a chunk of tasks, in the log"""
+    if len(task_ids) == 1:
+        return "task-{}".format(task_ids[0])
+    return "task-{} to task-{} ({} tasks)".format(task_ids[0], task_ids[-1], len(task_ids))
 
 
 class Sessions():
@@ -60,8 +238,34 @@ class Sessions():
     worker_num : int, optional
         The number of workers to execute tasks in parallel.
         Default is equal to number of available CPUs.
+    chunksize : int or str, optional
+        The number of tasks sent to a worker at once, or ``'auto'`` to size the chunks from the
+        measured duration of the tasks.
+        Default is ``1``.
     socket: internal use only
 
+    Notes
+    -----
+    The number of tasks in each status is counted as the tasks change status, and the status of
+    every task is kept as a code in the compact array ``status_codes``, so reading the status
+    costs the same however many tasks there are.
+
+    The workers are started once and wait for tasks until the session is shut down, so tasks can
+    be added at any time, also after ``start`` and while listening. Task functions that the workers
+    can't import, like functions cached through a proxy or defined after ``start``, are rebuilt from
+    their code and can't use closures.
+
+    Tasks are sent to the workers in chunks of ``chunksize`` tasks, which are reported as started
+    together and whose results come back together, so that many short tasks don't cost a round of
+    messages each. Tasks that don't fill a chunk are sent while the session is listening. With
+    ``'auto'``, the first tasks are sent one by one to measure how long they take, and more are only
+    sent while listening, about one chunk per worker ahead of the running ones.
+
+    The return value of every finished task is kept in ``results`` by task id, and the traceback of
+    every failed task in ``errors``. Large arrays are passed back from the workers through shared
+    memory when available, other large results through a file. When the session runs in a server,
+    results are cached on the server and ``results`` holds their references instead.
+
     Examples
     --------
 
@@ -77,13 +281,27 @@ class Sessions():
 
         s.add_task(func, 1)
         s.start()
-        s.listen()
+        for task_id, result in s.as_completed():
+            print(task_id, result)
 
     """
-    def __init__(self, log_path=None, worker_num=None, socket=None):
+    def __init__(self, log_path=None, worker_num=None, socket=None, chunksize=1):
         """init function"""
+        if chunksize != "auto" and chunksize < 1:
+            raise ValueError("chunksize should be a positive number or 'auto'")
         self.counter = 0
         self.tasks = {}
+        self.counts = dict((status, 0) for status in STATUSES)
+        self.status_codes = array('b')
+        self.lock = Lock()
+        self.workers = []
+        self.results = {}
+        self.errors = {}
+        self.chunksize = chunksize
+        self.pending = deque()
+        self.dispatched = 0
+        self.timed = 0
+        self.seconds = 0.0
         self.waiting = Queue()
         self.messages = Queue()
         self.log_path = log_path
@@ -93,87 +311,135 @@ class Sessions():
     def add_task(self, func, *args, **kwargs):
         """add a task function and its input parameters to the queue"""
         task = {"func": func, "args": args, "kwargs": kwargs, "status": "waiting"}
-        _id = len(self.tasks)
-        if self.log_path is not None:
-            task["log_path"] = os.path.join(self.log_path, "task-{}.log".format(_id))
-        else:
-            task["log_path"] = None
-        self.tasks[_id] = task
-        self.waiting.put(_id)
+        with self.lock:
+            _id = len(self.tasks)
+            if self.log_path is not None:
+                task["log_path"] = os.path.join(self.log_path, "task-{}.log".format(_id))
+            else:
+                task["log_path"] = None
+            # pickled here so that a task that can't be sent fails now rather than in the queue's thread
+            packed = pickle.dumps((_id, pack_function(func), args, kwargs, task["log_path"]), pickle.HIGHEST_PROTOCOL)
+            self.tasks[_id] = task
+            self.counts["waiting"] += 1
+            self.status_codes.append(STATUS_CODES["waiting"])
+            self.pending.append(packed)
+        if self.chunksize != "auto":
+            self.dispatch(partial=False)
+        return _id
+
+    def current_chunksize(self):
+        """return the size of the next chunk, estimated from the mean task duration with chunksize 'auto'"""
+        if self.chunksize != "auto":
+            return self.chunksize
+        if not self.timed:
+            return 1
+        mean = self.seconds / self.timed
+        if mean <= 0:
+            return MAX_CHUNKSIZE
+        return max(1, min(MAX_CHUNKSIZE, int(AUTO_CHUNK_SECONDS / mean)))
+
+    def dispatch(self, partial=True, throttle=True):
+        """send the tasks added so far to the workers in chunks, including a last partial chunk if asked"""
+        chunks = []
+        with self.lock:
+            size = self.current_chunksize()
+            while self.pending and (partial or len(self.pending) >= size):
+                if throttle and self.chunksize == "auto":
+                    started = self.counts["running"] + self.counts["finished"] + self.counts["failed"]
+                    if not self.workers or self.dispatched - started >= len(self.workers) * size:
+                        break
+                chunk = [self.pending.popleft() for _ in range(min(size, len(self.pending)))]
+                self.dispatched += len(chunk)
+                chunks.append(chunk)
+        for chunk in chunks:
+            self.waiting.put(chunk)
+
+    def set_status(self, task_id, status):
+        """change the status of a task and update the counters"""
+        with self.lock:
+            previous = self.tasks[task_id]["status"]
+            self.tasks[task_id]["status"] = status
+            self.counts[previous] -= 1
+            self.counts[status] += 1
+            self.status_codes[task_id] = STATUS_CODES[status]
 
     def create_workers(self, worker_num=None):
 
-        def worker(waiting, messages, tasks):
+        def worker(waiting, messages, shared, directory):
             pid = os.getpid()
             messages.put(("message", "worker {} started".format(pid)))
-            while not waiting.empty():
-                task_id = waiting.get()
-                task = tasks[task_id]
-                messages.put(("task_running", task_id))
-                with captured(task_id, log_path=task["log_path"]) as c:
-                    def output_reader(proc):
-                        if proc.log_path:
-                            messages.put(("message", "task-{}: streaming log to {}".format(proc.name, proc.log_path)))
-                            return
-                        out = proc.outfile
-                        lastpos = 0
-                        while True:
-                            if out.tell() != lastpos:
-                                out.seek(lastpos)
-                                line = out.read()
-                                if line[-16:] == TASK_FINISHED:
-                                    break
-                                messages.put(("task_log", "task-{} log: {}".format(proc.name, line)))
-                                lastpos = out.tell()
-                            time.sleep(0.05)
-
-                    t = Thread(target=output_reader, args=(c,))
-                    t.start()
-
-                    try:
-                        task["func"](*task["args"], **task["kwargs"])
-                        print(TASK_FINISHED, end="")
-                        t.join()
-                        messages.put(("task_finished", task_id))
-                        c.finished = True
-                    except Exception:
-                        traceback.print_exc()
-                        print(TASK_FINISHED, end="")
-                        t.join()
-                        messages.put(("task_failed", task_id))
+            output = TaskOutput(messages)
+            while True:
+                chunk = waiting.get()
+                if chunk is None:
+                    break
+                tasks = [pickle.loads(packed) for packed in chunk]
+                messages.put(("tasks_running", [task[0] for task in tasks]))
+                done = []
+                for task_id, func, args, kwargs, log_path in tasks:
+                    if log_path:
+                        messages.put(("message", "task-{}: streaming log to {}".format(task_id, log_path)))
+                    output.begin(task_id)
+                    start = time.time()
+                    with captured(output, log_path=log_path):
+                        try:
+                            result = unpack_function(func)(*args, **kwargs)
+                            done.append((task_id, True, pack_result(result, shared, directory), time.time() - start))
+                        except Exception:
+                            traceback.print_exc()
+                            done.append((task_id, False, traceback.format_exc(), time.time() - start))
+                messages.put(("tasks_done", done))
 
             messages.put(("message", "worker {} terminated".format(pid)))
 
         if self.worker_num is None:
             self.worker_num = cpu_count()
-        if self.worker_num > len(self.tasks):
-            self.worker_num = len(self.tasks)
 
         self.log("using {} workers".format(self.worker_num))
-        self.workers = [Process(target=worker, args=(self.waiting, self.messages, self.tasks)) for i in range(self.worker_num)]
+        args = (self.waiting, self.messages, shared_memory_available(), self.log_path)
+        self.workers = [Process(target=worker, args=args) for i in range(self.worker_num)]
 
     def process_message(self):
-
-        msg_type, content = self.messages.get()
-
-        if msg_type == "task_running":
-            key = content
-            self.tasks[key]["status"] = "running"
-            self.log("task-{}: started".format(key))
-
-        elif msg_type == "task_finished":
-            key = content
-            self.tasks[key]["status"] = "finished"
-            self.log("task-{}: finished".format(key))
-
-        elif msg_type == "task_failed":
-            key = content
-            self.tasks[key]["status"] = "failed"
-            self.log("task-{}: failed".format(key))
+        """process a message from the workers, return the ids of the tasks it completes"""
+
+        while True:
+            # send the tasks waiting for a chunk to fill up, or for running ones with chunksize 'auto'
+            self.dispatch()
+            try:
+                msg_type, content = self.messages.get(timeout=DISPATCH_INTERVAL)
+                break
+            except Empty:
+                pass
+
+        if msg_type == "tasks_running":
+            for key in content:
+                self.set_status(key, "running")
+            self.log("{}: started".format(describe(content)))
+
+        elif msg_type == "tasks_done":
+            finished = []
+            for key, succeeded, packed, seconds in content:
+                self.timed += 1
+                self.seconds += seconds
+                if succeeded:
+                    result = unpack_result(packed)
+                    if self.socket is not None:
+                        result = self.socket.cache({"cache": result})
+                    self.results[key] = result
+                    self.set_status(key, "finished")
+                    finished.append(key)
+                else:
+                    self.errors[key] = packed
+                    self.set_status(key, "failed")
+                    self.log("task-{}: failed".format(key))
+            if finished:
+                self.log("{}: finished".format(describe(finished)))
+            return [task[0] for task in content]
         elif msg_type == "task_log":
             self.log(content, end="")
         else:
             self.log(content)
+        return []
 
     def log(self, *args, **kwargs):
         print(self.status, "________", *args, **kwargs)
@@ -184,10 +450,15 @@ class Sessions():
 
     def start(self):
         """kick off the execution of tasks"""
+        if self.workers:
+            raise RuntimeError("Sessions already started")
         self.log("START")
         self.create_workers()
         for worker in self.workers:
             worker.start()
+        self.dispatch()
+        # workers wait for tasks until shut down, which the interpreter would otherwise wait for at exit
+        atexit.register(self.shutdown)
 
     def listen(self):
         """listen to the task messages until all finished"""
@@ -195,21 +466,50 @@ class Sessions():
             self.process_message()
         self.log("FINISHED")
 
+    def as_completed(self):
+        """listen to the task messages and yield the id and result of tasks as they complete, None for failed ones"""
+        while not self.all_finished() or not self.messages.empty():
+            for task_id in self.process_message():
+                yield task_id, self.results.get(task_id)
+        self.log("FINISHED")
+
     @property
     def status(self):
-        s = {"waiting": 0, "running": 0, "failed": 0, "finished": 0, "total": len(self.tasks)}
-        for k in self.tasks:
-            for key in s:
-                if self.tasks[k]['status'] == key:
-                    s[key] += 1
+        with self.lock:
+            s = dict(self.counts)
+            s["total"] = len(self.tasks)
         return s
 
     def all_finished(self):
-        return self.status["finished"] + self.status["failed"] == self.status["total"]
+        with self.lock:
+            return self.counts["finished"] + self.counts["failed"] == len(self.tasks)
+
+    def tasks_with_status(self, status):
+        """return the ids of the tasks in given status"""
+        code = STATUS_CODES[status]
+        return [i for i, c in enumerate(self.status_codes) if c == code]
+
+    def shutdown(self):
+        """stop the workers once they have run the tasks added so far"""
+        if self.workers:
+            self.dispatch(throttle=False)
+        for _ in self.workers:
+            self.waiting.put(None)
+        for w in self.workers:
+            w.join()
+        self.workers = []
+        self.forget_exit()
 
     def terminate(self):
         for w in self.workers:
             w.terminate()
+        self.workers = []
+        self.forget_exit()
+
+    def forget_exit(self):
+        """drop the shutdown at exit, which would otherwise keep the session and its queues alive"""
+        if hasattr(atexit, "unregister"):
+            atexit.unregister(self.shutdown)
 
     def summary(self):
         pass
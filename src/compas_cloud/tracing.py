@@ -0,0 +1,142 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+from collections import deque
+from threading import Lock
+from threading import current_thread
+
+
+__all__ = ['Tracer']
+
+
+PHASES = ('encode', 'send', 'wait', 'receive', 'decode')
+# number of calls and trace events kept, older ones are dropped
+MAX_CALLS = 10000
+MAX_EVENTS = 100000
+
+
+def request_name(data):
+    """return the name a request is traced and recorded under: the path of the function it calls or its type"""
+    if 'package' in data:
+        return data['package']
+    for key in data:
+        if key not in ('request_id', 'key', 'pin', 'scope', 'count'):
+            return key
+    return 'unknown'
+
+
+class Tracer(object):
+    """A recorder of the time spent in each phase of the calls made through a proxy.
+
+    Notes
+    -----
+    A call is split into encoding the request, sending it, waiting for the first byte of the response,
+    receiving the rest of it and decoding it. Clients that can't tell when a response started to arrive
+    have the whole reception counted as waiting, and no receive time.
+    Callback and log messages received while a call is waiting are counted as interleaved,
+    failed attempts of a function are recorded as retries.
+    Only the latest calls and trace events are kept.
+    The trace can be written as Chrome trace events, to be viewed in ``chrome://tracing`` or Perfetto.
+
+    """
+
+    def __init__(self, max_calls=MAX_CALLS, max_events=MAX_EVENTS):
+        self.calls = deque(maxlen=max_calls)
+        self.open = {}
+        self.events = deque(maxlen=max_events)
+        self.origin = time.time()
+        self.lock = Lock()
+
+    def span(self, name, category, start, end, tid, args=None):
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': 0, 'tid': tid,
+                 'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def sent(self, channel, data, start, encoded, sent, size):
+        """record the encoding and sending of a request"""
+        name = request_name(data)
+        with self.lock:
+            tid = 'request {}'.format(data.get('request_id', '-'))
+            self.span(name, 'encode', start, encoded, tid, {'bytes': size})
+            self.span(name, 'send', encoded, sent, tid)
+            if 'request_id' in data:
+                self.open[(channel, data['request_id'])] = {
+                    'request_id': data['request_id'], 'name': name, 'tid': tid,
+                    'start': start, 'sent': sent, 'first': None,
+                    'encode': encoded - start, 'send': sent - encoded,
+                    'request_bytes': size, 'interleaved': 0}
+
+    def received(self, channel, message, first_byte, received, decoded, size):
+        """record the reception of a message, completing the call it answers, first_byte is None if unknown"""
+        with self.lock:
+            if not isinstance(message, dict) or 'request_id' not in message:
+                kind = 'callback' if isinstance(message, dict) and 'callback' in message else 'listen'
+                for (c, _), call in self.open.items():
+                    if c == channel:
+                        call['interleaved'] += 1
+                self.span(kind, 'interleaved', first_byte or received, decoded, 'interleaved')
+                return
+
+            call = self.open.get((channel, message['request_id']))
+            if call is None:
+                return
+            if first_byte is not None:
+                # the reader of the client can receive the response before sending is marked as done
+                call['first'] = max(first_byte, call['sent'])
+
+            del self.open[(channel, message['request_id'])]
+            if call['first'] is None:
+                call['wait'] = received - call['sent']
+                call['receive'] = None
+                self.span(call['name'], 'wait', call['sent'], received, call['tid'], {'bytes': size})
+            else:
+                call['wait'] = call['first'] - call['sent']
+                call['receive'] = received - call['first']
+                self.span(call['name'], 'wait', call['sent'], call['first'], call['tid'])
+                self.span(call['name'], 'receive', call['first'], received, call['tid'], {'bytes': size})
+            call['decode'] = decoded - received
+            call['total'] = decoded - call['start']
+            call['response_bytes'] = size
+            self.span(call['name'], 'decode', received, decoded, call['tid'],
+                      {'interleaved': call['interleaved']})
+            for key in ('tid', 'sent', 'first'):
+                del call[key]
+            self.calls.append(call)
+
+    def retry(self, name, attempt, start, end, error):
+        """record a failed attempt of a call, including the wait before the next one"""
+        with self.lock:
+            self.span(name, 'retry', start, end, 'thread {}'.format(current_thread().name),
+                      {'attempt': attempt, 'error': str(error)})
+            self.calls.append({'name': name, 'retry': attempt, 'total': end - start, 'error': str(error)})
+
+    def summary(self):
+        """return the number of calls and the total and maximum time of each phase by request name"""
+        summary = {}
+        with self.lock:
+            calls = list(self.calls)
+        for call in calls:
+            entry = summary.setdefault(call['name'], {'calls': 0, 'retries': 0, 'interleaved': 0})
+            if 'retry' in call:
+                entry['retries'] += 1
+                continue
+            entry['calls'] += 1
+            entry['interleaved'] += call['interleaved']
+            for phase in PHASES + ('total',):
+                if call[phase] is None:
+                    continue
+                total, longest = entry.get(phase, (0.0, 0.0))
+                entry[phase] = (total + call[phase], max(longest, call[phase]))
+        return summary
+
+    def dump(self, path):
+        """write the trace to a file in the Chrome trace event format"""
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)